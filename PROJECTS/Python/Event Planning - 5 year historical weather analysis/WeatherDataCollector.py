@@ -1,19 +1,46 @@
+import logging
+
 import numpy as np
-from openmeteo import fetch_weather_data, process_daily_data
+from grid import snap_to_grid
+from hourly import aggregate_hourly, day_matrix
+from openmeteo import DAILY_VARIABLES, decode_daily_data, decode_hourly_data, fetch_daily_values, fetch_weather_data
+from running_stats import RunningStats, summarize
+from metrics import metrics
+from sketch import HistogramSketch, summarize_sketches
+
+logger = logging.getLogger(__name__)
 
 class WeatherDataCollector:
-    def __init__(self, latitude: float, longitude: float, month: int, day: int, year: int):
+    def __init__(self, latitude: float, longitude: float, month: int, day: int, year: int,
+                 years: int = 5, archive=None, grid_resolution: float = None, hourly=None, hours=()):
+        if years < 1:
+            raise ValueError(f"Lookback must cover at least one year, got {years}")
+
+        # With a grid resolution the collector works on the grid cell containing the point,
+        # so requests, archive files and database rows are shared by nearby locations
+        self.requested_latitude = latitude
+        self.requested_longitude = longitude
+        if grid_resolution:
+            latitude, longitude = snap_to_grid(latitude, longitude, grid_resolution)
+
         self.latitude = latitude
         self.longitude = longitude
         self.month = month
         self.day = day
         self.year = year
+        self.years = years
+        self.archive = archive
+
+        # One running accumulator and one percentile sketch per daily variable; nothing is kept per year
+        self.stats = {variable: RunningStats() for variable in DAILY_VARIABLES}
+        self.sketches = {variable: HistogramSketch.for_variable(variable) for variable in DAILY_VARIABLES}
 
-        self.temperatures_max = []
-        self.temperatures_min = []
-        self.temperatures_mean = []
-        self.precipitations_sum = []
-        self.wind_speeds_max = []
+        # Optional hourly variables (e.g. temperature_2m), reduced per target day to hour-of-day
+        # band means, the values at `hours` and a rolling max, each with its own accumulator
+        self.hourly = list(hourly or [])
+        self.hours = tuple(hours)
+        self.hourly_stats = {}
+        self.hourly_statistics = {}
 
         self.avg_temperature = None
         self.min_temperature = None
@@ -24,6 +51,10 @@ class WeatherDataCollector:
         self.sum_precipitation = None
         self.min_precipitation = None
         self.max_precipitation = None
+        self.p10_temperature = None
+        self.p50_temperature = None
+        self.p90_temperature = None
+        self.rain_probability = None
 
     def fetch_weather_data_for_year(self, year: int):
         """
@@ -32,61 +63,147 @@ class WeatherDataCollector:
         start_date = f"{year}-{self.month:02d}-{self.day:02d}"
         end_date = start_date
 
-        response = fetch_weather_data(self.latitude, self.longitude, start_date, end_date)
-        daily_df = process_daily_data(response)
-
-        # Debug: Print the entire dataframe to check for issues
-        print(daily_df)
+        response = fetch_weather_data(self.latitude, self.longitude, start_date, end_date, hourly=self.hourly)
+        values = decode_daily_data(response).to_array()[:1]
 
         # Check for NaN values and handle them
-        if daily_df.isnull().values.any():
-            print(f"Warning: Missing data detected for {start_date}")
+        if np.isnan(values).any():
+            logger.warning("Missing data detected for %s", start_date)
             return
 
-        self.temperatures_max.append(daily_df['temperature_2m_max'][0])
-        self.temperatures_min.append(daily_df['temperature_2m_min'][0])
-        self.temperatures_mean.append(daily_df['temperature_2m_mean'][0])
-        self.precipitations_sum.append(daily_df['precipitation_sum'][0])
-        self.wind_speeds_max.append(daily_df['wind_speed_10m_max'][0])
+        self.add_days(values)
+        if self.hourly:
+            self.add_hourly(np.array([start_date], dtype="datetime64[D]"), response)
+
+    def target_dates(self):
+        """
+        Return the selected day in each year of the lookback window, newest first.
+        February 29 is skipped in years that do not have one.
+        """
+        dates = []
+        for year in range(self.year, self.year - self.years, -1):
+            try:
+                dates.append(np.datetime64(f"{year}-{self.month:02d}-{self.day:02d}", "D"))
+            except ValueError:
+                logger.warning("%s has no %02d-%02d, skipping", year, self.month, self.day)
+        return np.array(dates, dtype="datetime64[D]")
 
-    def fetch_historical_data(self):
+    def daily_values(self, start_date, end_date):
         """
-        Fetch weather data for the selected day across the current year and the four preceding years.
+        Return the (day, variable) daily series between two dates. With an archive attached,
+        only the date ranges it does not hold yet are fetched, and the window is read from it.
         """
-        for year in range(self.year, self.year - 5, -1):
+        if self.archive is None:
+            return fetch_daily_values(self.latitude, self.longitude, start_date, end_date)
+
+        for gap_start, gap_end in self.archive.missing_ranges(self.latitude, self.longitude, start_date, end_date):
+            values = fetch_daily_values(self.latitude, self.longitude, gap_start, gap_end)
+            self.archive.write(self.latitude, self.longitude, gap_start, values)
+
+        return self.archive.read(self.latitude, self.longitude, start_date, end_date)
+
+    def fetch_historical_span(self):
+        """
+        Fetch the selected day for every year in the lookback window with a single request
+        covering the whole span, then pick out the target days by their offset from the start.
+        """
+        dates = self.target_dates()
+        if dates.size == 0:
+            return
+
+        start_date = dates.min()
+        end_date = dates.max()
+
+        values = self.daily_values(start_date, end_date)
+
+        offsets = (dates - start_date).astype(np.int64)
+        in_range = offsets < len(values)
+        rows = np.full((len(dates), len(DAILY_VARIABLES)), np.nan)
+        rows[in_range] = values[offsets[in_range]]
+
+        # Drop years with missing data, as the per-year path does
+        complete = ~np.isnan(rows).any(axis=1)
+        for date in dates[~complete]:
+            logger.warning("Missing data detected for %s", date)
+        rows = rows[complete]
+
+        self.add_days(rows)
+        if self.hourly:
+            self.add_hourly(dates)
+
+    def fetch_historical_data(self, single_request: bool = True):
+        """
+        Fetch weather data for the selected day across the current year and the preceding
+        years of the lookback window. By default the whole window is pulled in one request;
+        pass single_request=False to fetch each year separately.
+        """
+        if single_request:
+            self.fetch_historical_span()
+            return
+
+        for year in range(self.year, self.year - self.years, -1):
             self.fetch_weather_data_for_year(year)
 
-    def calculate_statistics(self):
+    def add_hourly(self, dates, response=None):
+        """
+        Fold the hourly aggregates of the given days into the hourly accumulators. Each day's
+        hourly variables are requested on their own, so only its 24 hours are downloaded and
+        decoded however long the lookback. A `response` already fetched with hourly=self.hourly
+        for the single day in `dates` is used as is.
+        """
+        for date in dates:
+            day_response = response
+            if day_response is None:
+                day_response = fetch_weather_data(self.latitude, self.longitude, str(date), str(date),
+                                                  hourly=self.hourly, daily=False)
+            series = decode_hourly_data(day_response, self.hourly)
+            for variable, values in zip(series.variables, series.values):
+                for name, per_day in aggregate_hourly(day_matrix(values), hours=self.hours).items():
+                    accumulator = self.hourly_stats.setdefault(f"{variable}_{name}", RunningStats())
+                    accumulator.update_many(per_day[~np.isnan(per_day)])
+
+    @metrics.timed("statistics")
+    def add_days(self, rows):
         """
-        Calculate the five-year averages, minimums, and maximums for each weather variable,
-        converting NumPy types to Python floats and rounding the results to 2 decimal places.
+        Fold (day, variable) rows of daily values into the running accumulators and sketches.
         """
-        if self.temperatures_mean:
-            self.avg_temperature = round(float(np.mean(self.temperatures_mean)), 2)
-            self.min_temperature = round(float(np.min(self.temperatures_min)), 2)
-            self.max_temperature = round(float(np.max(self.temperatures_max)), 2)
+        rows = np.asarray(rows, dtype=np.float64)
+        for j, variable in enumerate(DAILY_VARIABLES):
+            self.stats[variable].update_many(rows[:, j])
+            self.sketches[variable].update_many(rows[:, j])
 
-        if self.wind_speeds_max:
-            self.avg_wind_speed = round(float(np.mean(self.wind_speeds_max)), 2)
-            self.min_wind_speed = round(float(np.min(self.wind_speeds_max)), 2)
-            self.max_wind_speed = round(float(np.max(self.wind_speeds_max)), 2)
+    @metrics.timed("statistics")
+    def calculate_statistics(self):
+        """
+        Calculate the averages, minimums, and maximums over the lookback window for each weather
+        variable from the running accumulators, plus temperature percentiles and the chance of rain
+        from the sketches, as Python floats rounded to 2 decimal places. Hourly aggregates, if any,
+        go to hourly_statistics as {name: {"avg", "min", "max"}}.
+        """
+        statistics = summarize(self.stats)
+        statistics.update(summarize_sketches(self.sketches))
+        for column, value in statistics.items():
+            if value is not None:
+                setattr(self, column, value)
 
-        if self.precipitations_sum:
-            self.sum_precipitation = round(float(np.sum(self.precipitations_sum)), 2)
-            self.min_precipitation = round(float(np.min(self.precipitations_sum)), 2)
-            self.max_precipitation = round(float(np.max(self.precipitations_sum)), 2)
+        self.hourly_statistics = {
+            name: {"avg": round(float(accumulator.mean), 2), "min": round(float(accumulator.minimum), 2),
+                   "max": round(float(accumulator.maximum), 2)}
+            for name, accumulator in self.hourly_stats.items() if accumulator.count
+        }
 
 # Example usage for Austin, TX on August 16
-austin_weather = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024)
-austin_weather.fetch_historical_data()
-austin_weather.calculate_statistics()
-
-print(f"Five-Year Avg Temperature: {austin_weather.avg_temperature}")
-print(f"Five-Year Min Temperature: {austin_weather.min_temperature}")
-print(f"Five-Year Max Temperature: {austin_weather.max_temperature}")
-print(f"Five-Year Avg Wind Speed: {austin_weather.avg_wind_speed}")
-print(f"Five-Year Min Wind Speed: {austin_weather.min_wind_speed}")
-print(f"Five-Year Max Wind Speed: {austin_weather.max_wind_speed}")
-print(f"Five-Year Sum Precipitation: {austin_weather.sum_precipitation}")
-print(f"Five-Year Min Precipitation: {austin_weather.min_precipitation}")
-print(f"Five-Year Max Precipitation: {austin_weather.max_precipitation}")
+if __name__ == "__main__":
+    austin_weather = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024)
+    austin_weather.fetch_historical_data()
+    austin_weather.calculate_statistics()
+
+    print(f"Five-Year Avg Temperature: {austin_weather.avg_temperature}")
+    print(f"Five-Year Min Temperature: {austin_weather.min_temperature}")
+    print(f"Five-Year Max Temperature: {austin_weather.max_temperature}")
+    print(f"Five-Year Avg Wind Speed: {austin_weather.avg_wind_speed}")
+    print(f"Five-Year Min Wind Speed: {austin_weather.min_wind_speed}")
+    print(f"Five-Year Max Wind Speed: {austin_weather.max_wind_speed}")
+    print(f"Five-Year Sum Precipitation: {austin_weather.sum_precipitation}")
+    print(f"Five-Year Min Precipitation: {austin_weather.min_precipitation}")
+    print(f"Five-Year Max Precipitation: {austin_weather.max_precipitation}")
@@ -0,0 +1,130 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from openmeteo import DAILY_VARIABLES
+
+# The calendar the archive accepts; each location stores only the years it has data for
+ARCHIVE_START = np.datetime64("1940-01-01", "D")
+ARCHIVE_END = np.datetime64("2099-12-31", "D")
+YEAR_DAYS = 366
+
+# Year files kept memory-mapped at once; each open map holds a file descriptor
+MAX_OPEN_CHUNKS = 128
+
+
+class WeatherArchive:
+    """
+    Local columnar store of raw daily weather series. Each location gets a directory of
+    memory-mapped .npy files, one (day, variable) block per calendar year, created the first
+    time a day of that year is written. A day counts as fetched once it holds any value, so
+    days the API returned empty are fetched again, and any date window is a plain slice.
+    At most max_open_chunks year files stay mapped; the least recently used is flushed and let go.
+    """
+
+    def __init__(self, root: str = "archive", max_open_chunks: int = MAX_OPEN_CHUNKS):
+        self.root = root
+        self.max_open_chunks = max_open_chunks
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def cell_name(self, latitude: float, longitude: float):
+        return f"{latitude:.4f}_{longitude:.4f}"
+
+    def _years(self, start_date, end_date):
+        """
+        Yield (year, first row, end row, window offset) for each calendar year the window touches.
+        """
+        start = np.datetime64(start_date, "D")
+        end = np.datetime64(end_date, "D")
+        if start < ARCHIVE_START or end > ARCHIVE_END or end < start:
+            raise ValueError(f"Date window {start}..{end} is outside the archive calendar")
+
+        day = start
+        while day <= end:
+            year = day.astype("datetime64[Y]")
+            year_start = year.astype("datetime64[D]")
+            year_end = min((year + 1).astype("datetime64[D]") - 1, end)
+            yield (int(str(year)), int((day - year_start).astype(np.int64)),
+                   int((year_end - year_start).astype(np.int64)) + 1, int((day - start).astype(np.int64)))
+            day = year_end + 1
+
+    def _chunk(self, latitude: float, longitude: float, year: int, create: bool):
+        """
+        Return the memory map of one year of a cell, creating the file if asked to.
+        Returns None for a year that has never been written.
+        """
+        name = self.cell_name(latitude, longitude)
+        with self._lock:
+            if (name, year) in self._chunks:
+                self._chunks.move_to_end((name, year))
+                return self._chunks[name, year]
+
+            path = os.path.join(self.root, name, f"{year}.npy")
+            if not os.path.exists(path):
+                if not create:
+                    return None
+                # Write the empty block under a temporary name and rename it into place,
+                # so a crash never leaves a file behind that cannot be opened
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                partial = f"{path}.{os.getpid()}.tmp"
+                with open(partial, "wb") as f:
+                    np.save(f, np.full((YEAR_DAYS, len(DAILY_VARIABLES)), np.nan, dtype=np.float32))
+                os.replace(partial, path)
+
+            chunk = self._chunks[name, year] = np.load(path, mmap_mode="r+")
+            while len(self._chunks) > self.max_open_chunks:
+                # The map, and its descriptor, closes once a read or write still using it finishes
+                _, evicted = self._chunks.popitem(last=False)
+                evicted.flush()
+            return chunk
+
+    def read(self, latitude: float, longitude: float, start_date, end_date):
+        """
+        Return a (day, variable) copy of the archived window. Days never fetched are NaN.
+        """
+        years = list(self._years(start_date, end_date))
+        _, first, last, offset = years[-1]
+        window = np.full((offset + last - first, len(DAILY_VARIABLES)), np.nan, dtype=np.float32)
+        for year, first, last, offset in years:
+            chunk = self._chunk(latitude, longitude, year, create=False)
+            if chunk is not None:
+                window[offset:offset + last - first] = chunk[first:last]
+        return window
+
+    def write(self, latitude: float, longitude: float, start_date, values):
+        """
+        Store a (day, variable) block starting at start_date. Days whose values are all NaN,
+        as the archive returns for the most recent days, are left unfetched.
+        """
+        values = np.asarray(values, dtype=np.float32)
+        end_date = np.datetime64(start_date, "D") + len(values) - 1
+        for year, first, last, offset in self._years(start_date, end_date):
+            block = values[offset:offset + last - first]
+            present = ~np.isnan(block).all(axis=1)
+            if not present.any():
+                continue
+            chunk = self._chunk(latitude, longitude, year, create=True)
+            chunk[first:last][present] = block[present]
+            chunk.flush()
+
+    def missing_ranges(self, latitude: float, longitude: float, start_date, end_date):
+        """
+        Return the (start, end) date pairs, inclusive, of every run of unfetched days in the window.
+        """
+        missing = []
+        for year, first, last, _ in self._years(start_date, end_date):
+            chunk = self._chunk(latitude, longitude, year, create=False)
+            if chunk is None:
+                missing.append(np.ones(last - first, dtype=np.bool_))
+            else:
+                missing.append(np.isnan(chunk[first:last]).all(axis=1))
+        missing = np.concatenate(missing)
+
+        edges = np.diff(np.concatenate(([False], missing, [False])).astype(np.int8))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1) - 1
+        origin = np.datetime64(start_date, "D")
+        return [(origin + int(s), origin + int(e)) for s, e in zip(starts, ends)]
@@ -0,0 +1,128 @@
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from urllib.parse import urlparse
+
+import openmeteo
+from metrics import metrics
+from WeatherDataCollector import WeatherDataCollector
+
+logger = logging.getLogger(__name__)
+
+# A finished job: the (latitude, longitude, month, day, year) tuple, the collector with its
+# statistics calculated, and the last error if every attempt failed (collector is then None).
+BatchResult = namedtuple("BatchResult", ["job", "collector", "error"])
+
+
+class RateLimiter:
+    """
+    Spaces out calls so that no more than `rate` of them start per second, across all threads.
+    A rate of 0 (or None) disables the limit.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(host: str, rate: float):
+    """
+    Return the shared rate limiter for a host and rate, creating it on first use. Batches that use
+    the same host and rate share one limiter; a different rate gets a limiter of its own.
+    """
+    key = (host, rate)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(rate)
+        return _rate_limiters[key]
+
+
+def run_job(job, years: int, limiter: RateLimiter, retries: int, backoff: float,
+            archive=None, grid_resolution: float = None):
+    """
+    Collect and summarize one job, retrying failed attempts with exponential backoff and full jitter.
+    A job may carry a sixth element, its own lookback, which overrides `years`. Every archive
+    request the job makes, including archive gap fills and per-year requests, waits on `limiter`.
+    """
+    location_date, job_years = job[:5], job[5] if len(job) > 5 else years
+    error = None
+    token = openmeteo.request_limiter.set(limiter)
+    try:
+        for attempt in range(retries + 1):
+            if attempt:
+                metrics.increment("job_retries")
+                time.sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))
+
+            try:
+                collector = WeatherDataCollector(*location_date, years=job_years, archive=archive,
+                                                 grid_resolution=grid_resolution)
+                collector.fetch_historical_data()
+                collector.calculate_statistics()
+                return BatchResult(job, collector, None)
+            except Exception as e:
+                logger.warning("Attempt %d failed for %s: %s", attempt + 1, job, e)
+                error = e
+    finally:
+        openmeteo.request_limiter.reset(token)
+
+    metrics.increment("jobs_failed")
+    return BatchResult(job, None, error)
+
+
+def collect_batch(jobs, years: int = 5, max_workers: int = 8, requests_per_second: float = 5.0,
+                  retries: int = 3, backoff: float = 0.5, archive=None, grid_resolution: float = None):
+    """
+    Run (latitude, longitude, month, day, year[, years]) jobs on a bounded thread pool and yield a
+    BatchResult for each one as soon as it finishes. Jobs are pulled from the iterable lazily,
+    so arbitrarily long batches only keep a couple of jobs per worker in flight. An archive and
+    grid resolution are passed through to every WeatherDataCollector.
+    """
+    limiter = get_rate_limiter(urlparse(openmeteo.ARCHIVE_URL).netloc, requests_per_second)
+    jobs = iter(jobs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit(job):
+            return executor.submit(run_job, tuple(job), years, limiter, retries, backoff,
+                                   archive, grid_resolution)
+
+        pending = {submit(job): job for job in islice(jobs, max_workers * 2)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+                for job in islice(jobs, 1):
+                    pending[submit(job)] = job
+
+                yield future.result()
+
+
+# Example usage: a few candidate venues on August 16, 2024
+if __name__ == "__main__":
+    venues = [
+        (30.2672, -97.7431, 8, 16, 2024),
+        (29.7604, -95.3698, 8, 16, 2024),
+        (32.7767, -96.7970, 8, 16, 2024),
+    ]
+    for result in collect_batch(venues):
+        if result.error:
+            print(f"{result.job}: failed ({result.error})")
+        else:
+            print(f"{result.job}: avg temperature {result.collector.avg_temperature}")
@@ -0,0 +1,213 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import openmeteo_requests
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import openmeteo
+from batch import collect_batch
+from cache import WeatherCacheSession
+from database import Base, WeatherRecord, add_weather_record, bulk_add_weather_records
+from metrics import metrics
+from standin import StandInArchive
+
+DEFAULT_JOB_COUNTS = [1, 100, 10000]
+
+
+def make_rows(count):
+    """
+    Build `count` synthetic records with distinct keys spread over a grid of locations.
+    """
+    rows = []
+    for i in range(count):
+        date = datetime.date(2023, 1, 1) + datetime.timedelta(days=i % 365)
+        rows.append({
+            'latitude': round(30.0 + (i // 365) * 0.01, 4),
+            'longitude': -97.0,
+            'month': date.month,
+            'day': date.day,
+            'year': date.year,
+            'avg_temperature': 70.0 + i % 30,
+            'min_temperature': 60.0,
+            'max_temperature': 90.0,
+            'avg_wind_speed': 10.0,
+            'min_wind_speed': 5.0,
+            'max_wind_speed': 15.0,
+            'sum_precipitation': 0.5,
+            'min_precipitation': 0.0,
+            'max_precipitation': 0.2
+        })
+    return rows
+
+
+def new_session(directory, name):
+    engine = create_engine(f"sqlite:///{os.path.join(directory, name)}")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def bench_database_writes(rows):
+    """
+    Time the per-row add_weather_record path against bulk_add_weather_records on fresh
+    SQLite files and return rows/sec for each.
+    """
+    data = make_rows(rows)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        session = new_session(directory, 'single.db')
+        start = time.perf_counter()
+        for row in data:
+            add_weather_record(WeatherRecord(**row), session)
+        results['add_weather_record'] = rows / (time.perf_counter() - start)
+        session.close()
+
+        session = new_session(directory, 'bulk.db')
+        start = time.perf_counter()
+        bulk_add_weather_records(data, session)
+        results['bulk_add_weather_records'] = rows / (time.perf_counter() - start)
+
+        # A rerun over the same keys exercises the upsert path
+        start = time.perf_counter()
+        bulk_add_weather_records(data, session)
+        results['bulk_add_weather_records (upsert)'] = rows / (time.perf_counter() - start)
+        session.close()
+    return results
+
+
+def make_jobs(count, repeat_fraction=0.25):
+    """
+    Build `count` collector jobs for August 16, 2024. Locations are laid out on a 0.1 degree grid,
+    and roughly repeat_fraction of the jobs revisit an earlier location so the cache sees hits.
+    """
+    distinct = max(1, round(count * (1 - repeat_fraction)))
+    jobs = []
+    for i in range(count):
+        cell = i % distinct
+        jobs.append((round(25.0 + (cell // 100) * 0.1, 4), round(-100.0 + (cell % 100) * 0.1, 4), 8, 16, 2024))
+    return jobs
+
+
+def timed(function, samples):
+    """Wrap function so each call's duration in seconds is appended to samples."""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+    return wrapper
+
+
+def percentiles_ms(samples):
+    if not samples:
+        return {}
+    values = np.asarray(samples) * 1000
+    return {
+        'p50': round(float(np.percentile(values, 50)), 3),
+        'p90': round(float(np.percentile(values, 90)), 3),
+        'p99': round(float(np.percentile(values, 99)), 3),
+        'max': round(float(values.max()), 3),
+        'mean': round(float(values.mean()), 3)
+    }
+
+
+def bench_collector(jobs, archive_url, years=5, max_workers=8, repeat_fraction=0.25):
+    """
+    Run `jobs` collector jobs end to end against archive_url with a fresh HTTP cache, then
+    bulk write the results to a fresh database. Returns throughput, fetch latency and decode
+    time percentiles, the cache counters, the database write rate and the pipeline metrics.
+    """
+    latencies = []
+    decode_times = []
+    originals = (openmeteo.ARCHIVE_URL, openmeteo.openmeteo, openmeteo.fetch_weather_data,
+                 openmeteo.decode_daily_data)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = WeatherCacheSession(os.path.join(directory, 'cache'))
+        openmeteo.ARCHIVE_URL = archive_url
+        openmeteo.openmeteo = openmeteo_requests.Client(session=cache)
+        openmeteo.fetch_weather_data = timed(originals[2], latencies)
+        openmeteo.decode_daily_data = timed(originals[3], decode_times)
+        metrics.reset()
+        try:
+            start = time.perf_counter()
+            results = list(collect_batch(make_jobs(jobs, repeat_fraction), years=years,
+                                         max_workers=max_workers, requests_per_second=0, retries=0))
+            elapsed = time.perf_counter() - start
+        finally:
+            (openmeteo.ARCHIVE_URL, openmeteo.openmeteo, openmeteo.fetch_weather_data,
+             openmeteo.decode_daily_data) = originals
+
+        collectors = [result.collector for result in results if result.collector]
+        session = new_session(directory, 'collector.db')
+        start = time.perf_counter()
+        written = bulk_add_weather_records(collectors, session)
+        write_elapsed = time.perf_counter() - start
+        session.close()
+
+    return {
+        'jobs': jobs,
+        'failed': len(results) - len(collectors),
+        'seconds': round(elapsed, 3),
+        'jobs_per_sec': round(jobs / elapsed, 1),
+        'fetch_latency_ms': percentiles_ms(latencies),
+        'decode_ms': percentiles_ms(decode_times),
+        'cache': cache.cache_stats(),
+        'db_rows_per_sec': round(written / write_elapsed, 1) if written else 0.0,
+        'metrics': metrics.snapshot()
+    }
+
+
+def run_suite(job_counts, rows, recordings=None, latency=0.0, max_workers=8):
+    """
+    Run the database write benchmark and the collector benchmark at each job count against a
+    local stand-in of the archive API, so no request leaves the machine.
+    """
+    report = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'max_workers': max_workers,
+        'server_latency_ms': latency * 1000,
+        'database_writes': {name: round(rate, 1) for name, rate in bench_database_writes(rows).items()},
+        'collector': []
+    }
+    with StandInArchive(recordings=recordings, latency=latency) as archive:
+        for jobs in job_counts:
+            report['collector'].append(bench_collector(jobs, archive.url, max_workers=max_workers))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the weather collector and database write paths.")
+    parser.add_argument('--rows', type=int, default=2000, help="number of records to write")
+    parser.add_argument('--jobs', type=int, nargs='+', default=DEFAULT_JOB_COUNTS,
+                        help="collector job counts to run")
+    parser.add_argument('--workers', type=int, default=8, help="collector worker threads")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated server latency in milliseconds")
+    parser.add_argument('--recordings', help="directory of recorded archive responses to serve")
+    parser.add_argument('--output', default='benchmark_results.json', help="where to write the JSON report")
+    args = parser.parse_args()
+
+    report = run_suite(args.jobs, args.rows, args.recordings, args.latency / 1000, args.workers)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+
+    for name, rate in report['database_writes'].items():
+        print(f"{name}: {rate:,.0f} rows/sec")
+    for result in report['collector']:
+        print(f"{result['jobs']} jobs: {result['jobs_per_sec']:,.1f} jobs/sec, "
+              f"fetch p50/p99 {result['fetch_latency_ms']['p50']}/{result['fetch_latency_ms']['p99']} ms, "
+              f"decode p50 {result['decode_ms']['p50']} ms, cache hit ratio {result['cache']['hit_ratio']:.2f}, "
+              f"{result['db_rows_per_sec']:,.0f} rows/sec written")
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
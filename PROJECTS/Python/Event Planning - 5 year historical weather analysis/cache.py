@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+from urllib.parse import parse_qs, urlparse
+
+import requests_cache
+from metrics import metrics
+
+# max_bytes bounds the stored response bodies; recent_ttl applies to responses whose end_date is
+# within recent_days of today, since the archive revises its newest data, and old_ttl to the rest
+# (-1 never expires). The cache file is compacted after every vacuum_every evictions.
+CachePolicy = namedtuple(
+    "CachePolicy",
+    ["max_bytes", "recent_days", "recent_ttl", "old_ttl", "vacuum_every"],
+    defaults=[256 * 1024 * 1024, 92, timedelta(days=1), -1, 1000]
+)
+
+# Eviction frees a little more than it has to, so a full cache does not evict on every write
+EVICTION_HEADROOM = 0.9
+
+
+def expire_after_for(url, policy, today=None):
+    """
+    Pick the TTL for a request from the end_date in its query string. Returns None when the
+    request has no end_date, leaving the session default in place.
+    """
+    end_dates = parse_qs(urlparse(url).query).get("end_date")
+    if not end_dates:
+        return None
+    today = today or date.today()
+    end_date = date.fromisoformat(end_dates[0])
+    if end_date >= today - timedelta(days=policy.recent_days):
+        return policy.recent_ttl
+    return policy.old_ttl
+
+
+class WeatherCacheSession(requests_cache.CachedSession):
+    """
+    SQLite-backed HTTP cache with a byte budget. Every stored response gets a row in an lru table
+    holding its size and last access time; once the bodies exceed policy.max_bytes the least
+    recently used responses are deleted, and the file is vacuumed periodically to give the space back.
+    """
+
+    def __init__(self, cache_name=".cache", policy=CachePolicy(), **kwargs):
+        super().__init__(cache_name, backend="sqlite", expire_after=policy.old_ttl, **kwargs)
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.vacuums = 0
+        self._evicted_since_vacuum = 0
+        self._lock = threading.Lock()
+
+        with self.cache.responses.connection(commit=True) as con:
+            con.execute("CREATE TABLE IF NOT EXISTS lru (key PRIMARY KEY, accessed REAL, size INTEGER)")
+            con.execute("CREATE INDEX IF NOT EXISTS ix_lru_accessed ON lru (accessed)")
+            # Responses written before the budget existed are treated as the least recently used
+            con.execute("INSERT OR IGNORE INTO lru (key, accessed, size) "
+                        "SELECT key, 0, length(value) FROM responses")
+            self._bytes = con.execute("SELECT COALESCE(SUM(size), 0) FROM lru").fetchone()[0]
+
+    def send(self, request, expire_after=None, **kwargs):
+        if expire_after is None:
+            expire_after = expire_after_for(request.url, self.policy)
+        response = super().send(request, expire_after=expire_after, **kwargs)
+
+        key = getattr(response, "cache_key", None)
+        if getattr(response, "from_cache", False):
+            metrics.increment("cache_hits")
+            if key is not None:
+                self._touch(key)
+        else:
+            metrics.increment("cache_misses")
+            metrics.increment("bytes_received", len(response.content))
+            # Attempts retried by the urllib3 Retry that retry_requests mounts on the session
+            metrics.increment("retries", len(getattr(getattr(response.raw, "retries", None), "history", ())))
+            if key is not None:
+                self._record_write(key)
+        return response
+
+    def _touch(self, key):
+        with self._lock, self.cache.responses.connection(commit=True) as con:
+            self.hits += 1
+            con.execute("UPDATE lru SET accessed = ? WHERE key = ?", (time.time(), key))
+
+    def _record_write(self, key):
+        with self._lock:
+            self.misses += 1
+            with self.cache.responses.connection(commit=True) as con:
+                stored = con.execute("SELECT length(value) FROM responses WHERE key = ?", (key,)).fetchone()
+                if stored is None:
+                    # Not cacheable (e.g. an error status), so nothing was written
+                    return
+                previous = con.execute("SELECT size FROM lru WHERE key = ?", (key,)).fetchone()
+                con.execute("INSERT OR REPLACE INTO lru (key, accessed, size) VALUES (?, ?, ?)",
+                            (key, time.time(), stored[0]))
+                self._bytes += stored[0] - (previous[0] if previous else 0)
+
+            if self._bytes > self.policy.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete least recently used responses until the cache is back under its headroom."""
+        target = self.policy.max_bytes * EVICTION_HEADROOM
+        victims = []
+        freed = 0
+        with self.cache.responses.connection() as con:
+            for key, size in con.execute("SELECT key, size FROM lru ORDER BY accessed"):
+                if self._bytes - freed <= target:
+                    break
+                victims.append(key)
+                freed += size
+
+        with self.cache.responses.connection(commit=True) as con:
+            con.executemany("DELETE FROM lru WHERE key = ?", ((key,) for key in victims))
+        self.cache.responses.bulk_delete(keys=victims)
+        self.cache.redirects.bulk_delete(values=victims)
+        self._bytes -= freed
+        self.evictions += len(victims)
+        metrics.increment("cache_evictions", len(victims))
+
+        self._evicted_since_vacuum += len(victims)
+        if self._evicted_since_vacuum >= self.policy.vacuum_every:
+            self.cache.responses.vacuum()
+            self._evicted_since_vacuum = 0
+            self.vacuums += 1
+
+    def cache_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "vacuums": self.vacuums,
+                "bytes": self._bytes,
+                "max_bytes": self.policy.max_bytes
+            }
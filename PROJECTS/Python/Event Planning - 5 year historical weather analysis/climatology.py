@@ -0,0 +1,119 @@
+import numpy as np
+from database import CLIMATOLOGY_SKETCHES, STATISTIC_COLUMNS
+from openmeteo import DAILY_VARIABLES
+from sketch import HistogramSketch
+from WeatherDataCollector import WeatherDataCollector
+
+# Day-of-year slots follow a leap-year calendar so February 29 keeps its own slot (59)
+# and every other date maps to the same slot in every year
+DAYS_IN_MONTH = np.array([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+MONTH_OFFSETS = np.concatenate(([0], np.cumsum(DAYS_IN_MONTH)[:-1]))
+SLOT_MONTHS = np.repeat(np.arange(1, 13), DAYS_IN_MONTH)
+SLOT_DAYS = np.concatenate([np.arange(1, days + 1) for days in DAYS_IN_MONTH])
+SLOTS = len(SLOT_MONTHS)
+
+TEMPERATURE_MAX, TEMPERATURE_MIN, TEMPERATURE_MEAN, PRECIPITATION_SUM, WIND_SPEED_MAX = range(len(DAILY_VARIABLES))
+
+
+def day_of_year_slots(dates):
+    """
+    Map datetime64[D] dates to their 0-365 slot on the leap-year calendar.
+    """
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    months = dates.astype("datetime64[M]")
+    month_index = months.astype(np.int64) % 12
+    day_index = (dates - months.astype("datetime64[D]")).astype(np.int64)
+    return MONTH_OFFSETS[month_index] + day_index
+
+
+def build_climatology(dates, values):
+    """
+    Compute, for all 366 calendar days at once, the same statistics calculate_statistics produces
+    for one day: the mean daily temperature and wind speed, the lowest minimum and highest maximum,
+    and the summed precipitation, each rounded to 2 decimal places, plus a serialized sketch of
+    every daily variable for percentiles. `values` is a (day, variable) array aligned
+    with `dates`; days with any missing variable are left out, as the collector does.
+    Returns one dict per calendar day that has data.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    complete = ~np.isnan(values).any(axis=1)
+    slots = day_of_year_slots(dates)[complete]
+    values = values[complete]
+
+    counts = np.bincount(slots, minlength=SLOTS)
+    sums = np.stack(
+        [np.bincount(slots, weights=values[:, j], minlength=SLOTS) for j in range(values.shape[1])], axis=1
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts[:, None]
+
+    minimums = np.full((SLOTS, values.shape[1]), np.inf)
+    maximums = np.full((SLOTS, values.shape[1]), -np.inf)
+    np.minimum.at(minimums, slots, values)
+    np.maximum.at(maximums, slots, values)
+
+    stats = np.round(np.stack([
+        means[:, TEMPERATURE_MEAN],
+        minimums[:, TEMPERATURE_MIN],
+        maximums[:, TEMPERATURE_MAX],
+        means[:, WIND_SPEED_MAX],
+        minimums[:, WIND_SPEED_MAX],
+        maximums[:, WIND_SPEED_MAX],
+        sums[:, PRECIPITATION_SUM],
+        minimums[:, PRECIPITATION_SUM],
+        maximums[:, PRECIPITATION_SUM],
+    ], axis=1), 2)
+
+    sketches = {CLIMATOLOGY_SKETCHES[variable]: slot_sketches(slots, values[:, j], variable)
+                for j, variable in enumerate(DAILY_VARIABLES)}
+
+    rows = []
+    for slot in np.flatnonzero(counts):
+        row = dict(zip(STATISTIC_COLUMNS, stats[slot].tolist()))
+        row.update(month=int(SLOT_MONTHS[slot]), day=int(SLOT_DAYS[slot]), years=int(counts[slot]),
+                   **{column: slot_sketch[slot].to_bytes() for column, slot_sketch in sketches.items()})
+        rows.append(row)
+    return rows
+
+
+def slot_sketches(slots, values, variable):
+    """
+    Build one HistogramSketch per day-of-year slot with a single bincount over (slot, bin) pairs.
+    """
+    template = HistogramSketch.for_variable(variable)
+    bins = len(template.counts)
+    counts = np.bincount(slots * bins + template.bin_indices(values), minlength=SLOTS * bins)
+    counts = counts.reshape(SLOTS, bins).astype(np.uint32)
+    return [HistogramSketch(template.low, template.high, template.width, counts[slot]) for slot in range(SLOTS)]
+
+
+def collect_climatology(latitude: float, longitude: float, last_year: int, years: int = 30,
+                        archive=None, grid_resolution: float = None):
+    """
+    Fetch one multi-year daily series for a location (whole calendar years, ending with last_year)
+    and return its per-calendar-day climatology rows, ready for database.bulk_add_climatology.
+    """
+    collector = WeatherDataCollector(latitude, longitude, 1, 1, last_year, years=years,
+                                     archive=archive, grid_resolution=grid_resolution)
+    first_year = last_year - years + 1
+    start_date = np.datetime64(f"{first_year}-01-01", "D")
+    end_date = np.datetime64(f"{last_year}-12-31", "D")
+
+    values = collector.daily_values(start_date, end_date)
+    dates = start_date + np.arange(len(values))
+
+    rows = build_climatology(dates, values)
+    for row in rows:
+        row.update(latitude=collector.latitude, longitude=collector.longitude,
+                   first_year=first_year, last_year=last_year)
+    return rows
+
+
+# Example usage: build a 30-year climatology for Austin, TX and look up August 16
+if __name__ == "__main__":
+    from database import bulk_add_climatology, get_session, query_climatology
+
+    bulk_add_climatology(collect_climatology(30.2672, -97.7431, 2023), get_session())
+    record = query_climatology(30.2672, -97.7431, 8, 16)
+    print(f"August 16 over {record.years} years: avg {record.avg_temperature}°F, "
+          f"max {record.max_temperature}°F, total rain {record.sum_precipitation} in")
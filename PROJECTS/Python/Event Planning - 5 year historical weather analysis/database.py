@@ -1,15 +1,39 @@
-from sqlalchemy import create_engine, Column, Integer, Float
+import logging
+import threading
+import weakref
+
+import numpy as np
+from sqlalchemy import create_engine, event, case, func, select, Column, Integer, Float, Index, LargeBinary, String
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
+from metrics import metrics
+from running_stats import RunningStats, summarize
+from sketch import HistogramSketch
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Coordinates are keyed as integers in units of 1/10,000 degree (about 11 m), so lookups do
+# not depend on float equality
+COORDINATE_SCALE = 10_000
+
+
+def coordinate_key(value):
+    return int(round(value * COORDINATE_SCALE))
+
 class WeatherRecord(Base):
     __tablename__ = 'weather_records'
+    __table_args__ = (
+        Index('ix_weather_records_key', 'latitude_key', 'longitude_key', 'month', 'day', 'year', unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
+    latitude_key = Column(Integer, nullable=False)
+    longitude_key = Column(Integer, nullable=False)
     month = Column(Integer, nullable=False)
     day = Column(Integer, nullable=False)
     year = Column(Integer, nullable=False)
@@ -22,13 +46,17 @@ class WeatherRecord(Base):
     sum_precipitation = Column(Float)
     min_precipitation = Column(Float)
     max_precipitation = Column(Float)
+    # Years of history behind the statistics; NULL for records from older versions
+    lookback = Column(Integer)
 
     def __init__(self, latitude, longitude, month, day, year,
                  avg_temperature, min_temperature, max_temperature,
                  avg_wind_speed, min_wind_speed, max_wind_speed,
-                 sum_precipitation, min_precipitation, max_precipitation):
+                 sum_precipitation, min_precipitation, max_precipitation, lookback=None):
         self.latitude = latitude
         self.longitude = longitude
+        self.latitude_key = coordinate_key(latitude)
+        self.longitude_key = coordinate_key(longitude)
         self.month = month
         self.day = day
         self.year = year
@@ -41,28 +69,505 @@ class WeatherRecord(Base):
         self.sum_precipitation = sum_precipitation
         self.min_precipitation = min_precipitation
         self.max_precipitation = max_precipitation
+        self.lookback = lookback
+
+class VariableStats(Base):
+    """
+    Running accumulator (see running_stats.RunningStats) and serialized percentile sketch
+    (see sketch.HistogramSketch) for one daily variable behind a WeatherRecord, stored under the
+    same key so the record can be extended by a year at a time.
+    """
+    __tablename__ = 'variable_stats'
+    __table_args__ = (
+        Index('ix_variable_stats_key', 'latitude_key', 'longitude_key', 'month', 'day', 'year', 'variable',
+              unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    latitude_key = Column(Integer, nullable=False)
+    longitude_key = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    day = Column(Integer, nullable=False)
+    year = Column(Integer, nullable=False)
+    variable = Column(String, nullable=False)
+    count = Column(Integer, nullable=False)
+    mean = Column(Float, nullable=False)
+    m2 = Column(Float, nullable=False)
+    minimum = Column(Float, nullable=False)
+    maximum = Column(Float, nullable=False)
+    total = Column(Float, nullable=False)
+    sketch = Column(LargeBinary)
+
+class ClimatologyRecord(Base):
+    """
+    Statistics for one calendar day at one location, computed over every year of a multi-year
+    series (see climatology.py). One row per (location, month, day), including February 29.
+    One sketch per daily variable (see CLIMATOLOGY_SKETCHES) holds its distribution for percentiles.
+    """
+    __tablename__ = 'climatology'
+    __table_args__ = (
+        Index('ix_climatology_key', 'latitude_key', 'longitude_key', 'month', 'day', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    latitude_key = Column(Integer, nullable=False)
+    longitude_key = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    day = Column(Integer, nullable=False)
+    first_year = Column(Integer, nullable=False)
+    last_year = Column(Integer, nullable=False)
+    years = Column(Integer, nullable=False)
+    avg_temperature = Column(Float)
+    min_temperature = Column(Float)
+    max_temperature = Column(Float)
+    avg_wind_speed = Column(Float)
+    min_wind_speed = Column(Float)
+    max_wind_speed = Column(Float)
+    sum_precipitation = Column(Float)
+    min_precipitation = Column(Float)
+    max_precipitation = Column(Float)
+    temperature_sketch = Column(LargeBinary)
+    precipitation_sketch = Column(LargeBinary)
+    max_temperature_sketch = Column(LargeBinary)
+    min_temperature_sketch = Column(LargeBinary)
+    wind_speed_sketch = Column(LargeBinary)
+
+# Sketch column of each daily variable in the climatology table
+CLIMATOLOGY_SKETCHES = {
+    'temperature_2m_max': 'max_temperature_sketch',
+    'temperature_2m_min': 'min_temperature_sketch',
+    'temperature_2m_mean': 'temperature_sketch',
+    'precipitation_sum': 'precipitation_sketch',
+    'wind_speed_10m_max': 'wind_speed_sketch'
+}
+
+# Columns that identify a record; reruns for the same key update it in place
+RECORD_KEY = ['latitude_key', 'longitude_key', 'month', 'day', 'year']
+CLIMATOLOGY_KEY = ['latitude_key', 'longitude_key', 'month', 'day']
+VARIABLE_STATS_KEY = RECORD_KEY + ['variable']
+ACCUMULATOR_COLUMNS = ['count', 'mean', 'm2', 'minimum', 'maximum', 'total']
+STATISTIC_COLUMNS = [
+    'avg_temperature', 'min_temperature', 'max_temperature',
+    'avg_wind_speed', 'min_wind_speed', 'max_wind_speed',
+    'sum_precipitation', 'min_precipitation', 'max_precipitation'
+]
+
+
+def add_missing_columns(connection, table, columns):
+    existing = {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+    if not existing:
+        return
+    for column, column_type in columns.items():
+        if column not in existing:
+            connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+def has_index(connection, table, name):
+    return any(row[1] == name for row in connection.exec_driver_sql(f"PRAGMA index_list({table})"))
+
+def migrate_database(engine):
+    """
+    Bring tables created by an older version up to date: add columns introduced since, backfill
+    the scaled coordinate keys of weather_records, drop duplicate rows (keeping the newest), and
+    create the unique lookup index. Safe to run repeatedly; once the index exists only the
+    column checks run, so an up-to-date database is not scanned.
+    """
+    with engine.begin() as connection:
+        migrate_tables(connection)
+
+def migrate_tables(connection):
+    """
+    The steps of migrate_database, run on an open connection inside its transaction.
+    """
+    add_missing_columns(connection, 'weather_records',
+                        {'latitude_key': 'INTEGER', 'longitude_key': 'INTEGER', 'lookback': 'INTEGER'})
+    add_missing_columns(connection, 'variable_stats', {'sketch': 'BLOB'})
+    add_missing_columns(connection, 'climatology', {column: 'BLOB' for column in CLIMATOLOGY_SKETCHES.values()})
+    if has_index(connection, 'weather_records', 'ix_weather_records_key'):
+        return
+
+    rows = connection.exec_driver_sql(
+        "SELECT id, latitude, longitude FROM weather_records "
+        "WHERE latitude_key IS NULL OR longitude_key IS NULL"
+    ).fetchall()
+    if rows:
+        connection.exec_driver_sql(
+            "UPDATE weather_records SET latitude_key = ?, longitude_key = ? WHERE id = ?",
+            [(coordinate_key(latitude), coordinate_key(longitude), record_id)
+             for record_id, latitude, longitude in rows]
+        )
+
+    key = ", ".join(RECORD_KEY)
+    connection.exec_driver_sql(
+        f"DELETE FROM weather_records WHERE id NOT IN "
+        f"(SELECT MAX(id) FROM weather_records GROUP BY {key})"
+    )
+    connection.exec_driver_sql(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS ix_weather_records_key ON weather_records ({key})"
+    )
+
+# SQLAlchemy setup. The engine is created on first use rather than on import, and every thread
+# gets its own session from the scoped Session registry.
+DATABASE_URL = 'sqlite:///weather_data.db'
+
+# Applied to every new SQLite connection. WAL lets readers run alongside a writer; NORMAL
+# synchronous is durable in WAL mode and avoids an fsync per commit.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+    'cache_size': -20000
+}
 
-# SQLAlchemy setup
-engine = create_engine('sqlite:///weather_data.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+Session = scoped_session(sessionmaker())
+_engine = None
+# Reentrant, since get_engine holds it while configure() takes it again
+_engine_lock = threading.RLock()
+
+# Engines whose weather_records table is known to carry the unique key index
+_indexed_engines = weakref.WeakSet()
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+def configure(url=DATABASE_URL, **engine_options):
+    """
+    Create the engine for a database URL (replacing any previous one), bring its schema up to
+    date, and bind the Session registry to it. Extra keyword arguments go to create_engine,
+    for example pool_size. Returns the engine.
+    """
+    global _engine
+    with _engine_lock:
+        engine = create_engine(url, **engine_options)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', set_sqlite_pragmas)
+        Base.metadata.create_all(engine)
+        migrate_database(engine)
+
+        Session.remove()
+        Session.configure(bind=engine)
+        if _engine is not None:
+            _engine.dispose()
+        _engine = engine
+        return engine
+
+def get_engine():
+    """
+    Return the configured engine, creating the default one on first use. The check runs under
+    the engine lock, so threads racing on first use configure and migrate only once.
+    """
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                configure()
+    return _engine
+
+def get_session():
+    """
+    Return the calling thread's session, creating the default engine on first use.
+    """
+    get_engine()
+    return Session()
+
+def __getattr__(name):
+    # Keep `database.engine` and `database.session` working without connecting at import time
+    if name == 'engine':
+        return get_engine()
+    if name == 'session':
+        return get_session()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def add_weather_record(record, session):
-    session.add(record)
-    session.commit()
+    with metrics.phase("db_write"):
+        session.add(record)
+        session.commit()
+    metrics.increment("rows_written")
 
-def query_weather_record(latitude, longitude, month, day, year):
-    record = session.query(WeatherRecord).filter_by(
-        latitude=latitude,
-        longitude=longitude,
+def bulk_add_weather_records(records, session, chunk_size=500):
+    """
+    Upsert many records in a single transaction, sending them as executemany batches of
+    chunk_size rows. Records whose key already exists have their statistics and lookback overwritten.
+    Accepts WeatherRecord instances, WeatherDataCollectors (whose `years` is the lookback) or dicts
+    with the same fields. Returns the number of rows sent.
+    """
+    rows = []
+    for record in records:
+        if isinstance(record, dict):
+            row = dict(record)
+            row.setdefault('lookback', None)
+        else:
+            row = {column: getattr(record, column) for column in ['latitude', 'longitude'] + STATISTIC_COLUMNS}
+            row.update(month=record.month, day=record.day, year=record.year,
+                       lookback=getattr(record, 'lookback', getattr(record, 'years', None)))
+        row['latitude_key'] = coordinate_key(row['latitude'])
+        row['longitude_key'] = coordinate_key(row['longitude'])
+        rows.append(row)
+
+    ensure_record_index(session)
+    return upsert_rows(WeatherRecord, rows, RECORD_KEY, STATISTIC_COLUMNS + ['lookback'], session, chunk_size)
+
+def ensure_record_index(session):
+    """
+    Make sure weather_records has the unique key index the upsert's ON CONFLICT relies on. A table
+    from an older version, reached through a session that configure() did not migrate, is migrated
+    in the session's transaction first. Checked once per engine.
+    """
+    engine = session.get_bind()
+    if engine in _indexed_engines:
+        return
+    connection = session.connection()
+    if not has_index(connection, 'weather_records', 'ix_weather_records_key'):
+        migrate_tables(connection)
+    _indexed_engines.add(engine)
+
+def upsert_rows(model, rows, key_columns, update_columns, session, chunk_size=500):
+    """
+    Insert row dicts into a model's table in one transaction, as executemany batches of
+    chunk_size rows, overwriting update_columns where key_columns already exist.
+    """
+    statement = insert(model)
+    statement = statement.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={column: statement.excluded[column] for column in update_columns}
+    )
+    try:
+        with metrics.phase("db_write"):
+            for i in range(0, len(rows), chunk_size):
+                session.execute(statement, rows[i:i + chunk_size])
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    metrics.increment("rows_written", len(rows))
+    return len(rows)
+
+def running_stats_rows(latitude, longitude, month, day, year, stats, sketches=None):
+    """
+    Build variable_stats rows for the non-empty accumulators of one record.
+    """
+    key = record_key_filter(latitude, longitude, month, day, year)
+    sketches = sketches or {}
+    rows = []
+    for variable, accumulator in stats.items():
+        if accumulator.count:
+            sketch = sketches.get(variable)
+            rows.append(dict(key, variable=variable, sketch=sketch.to_bytes() if sketch else None,
+                             **accumulator.to_dict()))
+    return rows
+
+def save_running_stats(latitude, longitude, month, day, year, stats, session, sketches=None):
+    """
+    Upsert the per-variable accumulators, and optionally percentile sketches, behind the record
+    with the given key.
+    """
+    rows = running_stats_rows(latitude, longitude, month, day, year, stats, sketches)
+    return upsert_rows(VariableStats, rows, VARIABLE_STATS_KEY, ACCUMULATOR_COLUMNS + ['sketch'], session)
+
+def bulk_save_running_stats(collectors, session, chunk_size=500):
+    """
+    Upsert the accumulators and sketches of many collectors in one transaction.
+    """
+    rows = []
+    for collector in collectors:
+        rows.extend(running_stats_rows(collector.latitude, collector.longitude, collector.month, collector.day,
+                                       collector.year, collector.stats, collector.sketches))
+    return upsert_rows(VariableStats, rows, VARIABLE_STATS_KEY, ACCUMULATOR_COLUMNS + ['sketch'], session,
+                       chunk_size)
+
+def load_running_stats(latitude, longitude, month, day, year, session):
+    """
+    Return the stored accumulators and sketches behind a record as
+    ({variable: RunningStats}, {variable: HistogramSketch}).
+    """
+    rows = session.query(VariableStats).filter_by(**record_key_filter(latitude, longitude, month, day, year))
+    stats, sketches = {}, {}
+    for row in rows:
+        stats[row.variable] = RunningStats.from_dict(vars(row))
+        if row.sketch is not None:
+            sketches[row.variable] = HistogramSketch.from_bytes(row.variable, row.sketch)
+    return stats, sketches
+
+def extend_weather_record(latitude, longitude, month, day, year, new_stats, session, new_sketches=None, years=1):
+    """
+    Merge accumulators (and sketches) for newly collected days, for example a
+    WeatherDataCollector's stats for one more year, into the stored ones, and rewrite the
+    record's statistics from the merged result. The stored lookback grows by `years`, the
+    years the new days cover. Only the five variable rows and the record are read and written.
+    """
+    lookback = session.query(WeatherRecord.lookback).filter_by(
+        **record_key_filter(latitude, longitude, month, day, year)
+    ).scalar()
+    stats, sketches = load_running_stats(latitude, longitude, month, day, year, session)
+    for variable, accumulator in new_stats.items():
+        stats.setdefault(variable, RunningStats()).merge(accumulator)
+    for variable, sketch in (new_sketches or {}).items():
+        if variable in sketches:
+            sketches[variable].merge(sketch)
+        else:
+            sketches[variable] = sketch
+
+    save_running_stats(latitude, longitude, month, day, year, stats, session, sketches)
+    row = dict(latitude=latitude, longitude=longitude, month=month, day=day, year=year,
+               lookback=lookback + years if lookback is not None else None, **summarize(stats))
+    bulk_add_weather_records([row], session)
+    return row
+
+def record_key_filter(latitude, longitude, month, day, year):
+    """
+    Return filter_by() arguments that match a record on its indexed lookup key.
+    """
+    return dict(
+        latitude_key=coordinate_key(latitude),
+        longitude_key=coordinate_key(longitude),
         month=month,
         day=day,
         year=year
+    )
+
+def existing_record_keys(years, session=None):
+    """
+    Return {(latitude_key, longitude_key, month, day, year): lookback} for every stored record in
+    the given years, so a batch can skip work that is already done with one query.
+    """
+    session = session or get_session()
+    columns = [getattr(WeatherRecord, column) for column in RECORD_KEY]
+    statement = select(*columns, WeatherRecord.lookback).where(WeatherRecord.year.in_(sorted(set(years))))
+    return {tuple(row[:-1]): row[-1] for row in session.execute(statement)}
+
+def query_weather_record(latitude, longitude, month, day, year, session=None):
+    session = session or get_session()
+    record = session.query(WeatherRecord).filter_by(
+        **record_key_filter(latitude, longitude, month, day, year)
     ).first()
 
     if record:
         return record
     else:
-        print(f"No data found for {latitude}, {longitude} on {month}/{day}/{year}")
+        logger.warning("No data found for %s, %s on %s/%s/%s", latitude, longitude, month, day, year)
         return None
+
+def bulk_add_climatology(rows, session):
+    """
+    Upsert the per-day rows built by climatology.build_climatology for one location.
+    """
+    rows = [dict(row, latitude_key=coordinate_key(row['latitude']), longitude_key=coordinate_key(row['longitude']))
+            for row in rows]
+    update_columns = ['latitude', 'longitude', 'first_year', 'last_year', 'years'] + STATISTIC_COLUMNS + \
+        list(CLIMATOLOGY_SKETCHES.values())
+    return upsert_rows(ClimatologyRecord, rows, CLIMATOLOGY_KEY, update_columns, session)
+
+def query_climatology(latitude, longitude, month, day, session=None):
+    """
+    Return the ClimatologyRecord for a location and calendar day with a single indexed read,
+    or None if no climatology has been built for that location.
+    """
+    session = session or get_session()
+    return session.query(ClimatologyRecord).filter_by(
+        latitude_key=coordinate_key(latitude),
+        longitude_key=coordinate_key(longitude),
+        month=month,
+        day=day
+    ).first()
+
+def fetch_columns(statement, session=None):
+    """
+    Execute a Core select and return its result as {column name: NumPy array}, skipping ORM
+    object construction. Columns holding any float or NULL come back as float64 with NaN for NULL,
+    as do the columns of an empty result.
+    """
+    session = session or get_session()
+    result = session.execute(statement)
+    names = list(result.keys())
+    rows = result.all()
+
+    columns = {}
+    for name, values in zip(names, zip(*rows) if rows else [()] * len(names)):
+        if not values or any(value is None or isinstance(value, float) for value in values):
+            columns[name] = np.array(values, dtype=np.float64)
+        else:
+            columns[name] = np.array(values, dtype=np.int64)
+    return columns
+
+def location_conditions(latitude, longitude):
+    return [WeatherRecord.latitude_key == coordinate_key(latitude),
+            WeatherRecord.longitude_key == coordinate_key(longitude)]
+
+def bounding_box_conditions(south, west, north, east):
+    return [WeatherRecord.latitude_key.between(coordinate_key(south), coordinate_key(north)),
+            WeatherRecord.longitude_key.between(coordinate_key(west), coordinate_key(east))]
+
+def query_month(latitude, longitude, month, year=None, session=None):
+    """
+    Return every stored day of a month at one location as columnar arrays (day, year and the
+    statistic columns), ordered by day and year. Pass year to restrict to one window.
+    """
+    conditions = location_conditions(latitude, longitude) + [WeatherRecord.month == month]
+    if year is not None:
+        conditions.append(WeatherRecord.year == year)
+
+    columns = [WeatherRecord.day, WeatherRecord.year] + [getattr(WeatherRecord, name) for name in STATISTIC_COLUMNS]
+    statement = select(*columns).where(*conditions).order_by(WeatherRecord.day, WeatherRecord.year)
+    return fetch_columns(statement, session)
+
+def query_bounding_box(south, west, north, east, month, day, year=None, session=None):
+    """
+    Return the records of every location inside a latitude/longitude box for one calendar day
+    as columnar arrays (latitude, longitude, year and the statistic columns).
+    """
+    conditions = bounding_box_conditions(south, west, north, east) + \
+        [WeatherRecord.month == month, WeatherRecord.day == day]
+    if year is not None:
+        conditions.append(WeatherRecord.year == year)
+
+    columns = [WeatherRecord.latitude, WeatherRecord.longitude, WeatherRecord.year] + \
+        [getattr(WeatherRecord, name) for name in STATISTIC_COLUMNS]
+    statement = select(*columns).where(*conditions).order_by(WeatherRecord.latitude_key, WeatherRecord.longitude_key)
+    return fetch_columns(statement, session)
+
+def aggregate_statement(group_by, conditions, hot_threshold, rain_threshold):
+    """
+    Build a grouped select that computes averages, extremes and threshold counts inside SQLite.
+    """
+    return select(
+        *group_by,
+        func.count().label('records'),
+        func.avg(WeatherRecord.avg_temperature).label('avg_temperature'),
+        func.min(WeatherRecord.min_temperature).label('min_temperature'),
+        func.max(WeatherRecord.max_temperature).label('max_temperature'),
+        func.avg(WeatherRecord.avg_wind_speed).label('avg_wind_speed'),
+        func.max(WeatherRecord.max_wind_speed).label('max_wind_speed'),
+        func.avg(WeatherRecord.sum_precipitation).label('avg_precipitation'),
+        func.sum(case((WeatherRecord.max_temperature >= hot_threshold, 1), else_=0)).label('hot_records'),
+        func.sum(case((WeatherRecord.max_precipitation >= rain_threshold, 1), else_=0)).label('rainy_records')
+    ).where(*conditions).group_by(*group_by).order_by(*group_by)
+
+def aggregate_month(latitude, longitude, month, hot_threshold=95.0, rain_threshold=0.1, session=None):
+    """
+    Aggregate a location's records for one month per day, across all stored years: record count,
+    average/extreme temperature and wind, average precipitation, and how many records reach the
+    heat and rain thresholds. Returns columnar arrays keyed by column name.
+    """
+    conditions = location_conditions(latitude, longitude) + [WeatherRecord.month == month]
+    statement = aggregate_statement([WeatherRecord.day], conditions, hot_threshold, rain_threshold)
+    return fetch_columns(statement, session)
+
+def aggregate_bounding_box(south, west, north, east, month, day, hot_threshold=95.0, rain_threshold=0.1,
+                           session=None):
+    """
+    Aggregate the records of one calendar day per location inside a latitude/longitude box, with
+    the same columns as aggregate_month plus latitude and longitude.
+    """
+    conditions = bounding_box_conditions(south, west, north, east) + \
+        [WeatherRecord.month == month, WeatherRecord.day == day]
+    group_by = [WeatherRecord.latitude_key, WeatherRecord.longitude_key]
+    statement = aggregate_statement(group_by, conditions, hot_threshold, rain_threshold).add_columns(
+        func.min(WeatherRecord.latitude).label('latitude'),
+        func.min(WeatherRecord.longitude).label('longitude')
+    )
+    return fetch_columns(statement, session)
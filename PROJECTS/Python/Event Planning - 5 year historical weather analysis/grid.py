@@ -0,0 +1,20 @@
+# Open-Meteo answers archive requests from reanalysis grids rather than exact points:
+# ERA5-Land on a 0.1 degree grid, ERA5 on a 0.25 degree grid. Any coordinate inside a cell
+# resolves to the same grid point, so snapping requests to that point lets nearby venues
+# share HTTP cache entries, archive files and database rows.
+DEFAULT_GRID_RESOLUTION = 0.1
+
+
+def snap_coordinate(value: float, resolution: float = DEFAULT_GRID_RESOLUTION):
+    """
+    Return the grid point nearest to a latitude or longitude, rounded to 4 decimal places
+    so that the same cell always produces the same request URL and storage key.
+    """
+    return round(round(value / resolution) * resolution, 4)
+
+
+def snap_to_grid(latitude: float, longitude: float, resolution: float = DEFAULT_GRID_RESOLUTION):
+    """
+    Return the (latitude, longitude) of the grid cell a point falls into.
+    """
+    return snap_coordinate(latitude, resolution), snap_coordinate(longitude, resolution)
@@ -0,0 +1,46 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+HOURS_PER_DAY = 24
+
+# Hour-of-day bands in local time, as [start, end) hours
+HOUR_BANDS = {
+    "night": (0, 6),
+    "morning": (6, 12),
+    "afternoon": (12, 18),
+    "evening": (18, 24)
+}
+
+# Width of the window whose mean is maximized for the rolling max aggregate
+ROLLING_HOURS = 3
+
+
+def day_matrix(values, day_offsets=None):
+    """
+    View an hourly series that starts at local midnight as a (day, hour) matrix. With
+    day_offsets, gather only those days, so the aggregates are computed over the selected days only.
+    """
+    values = np.asarray(values)
+    days = len(values) // HOURS_PER_DAY
+    matrix = values[:days * HOURS_PER_DAY].reshape(days, HOURS_PER_DAY)
+    if day_offsets is None:
+        return matrix
+    return matrix[np.asarray(day_offsets, dtype=np.int64)]
+
+
+def aggregate_hourly(days, bands=HOUR_BANDS, hours=(), rolling_hours=ROLLING_HOURS):
+    """
+    Reduce a (day, hour) matrix to per-day values: the mean of each hour-of-day band, the value
+    at each requested hour, and the highest rolling_hours mean of the day. Returns a dict of
+    1-D float64 arrays keyed by aggregate name.
+    """
+    days = np.asarray(days, dtype=np.float64)
+    aggregates = {}
+    for band, (start, end) in bands.items():
+        aggregates[band] = days[:, start:end].mean(axis=1)
+    for hour in hours:
+        aggregates[f"{hour:02d}h"] = days[:, hour]
+    if rolling_hours:
+        windows = sliding_window_view(days, rolling_hours, axis=1)
+        aggregates[f"rolling_max_{rolling_hours}h"] = windows.mean(axis=2).max(axis=1)
+    return aggregates
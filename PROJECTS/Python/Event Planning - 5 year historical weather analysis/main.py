@@ -1,7 +1,199 @@
+import argparse
+import csv
+import datetime
+import logging
+import os
+import time
+
 from WeatherDataCollector import WeatherDataCollector
-from database import WeatherRecord, add_weather_record, query_weather_record
+from batch import collect_batch
+from database import (WeatherRecord, bulk_add_weather_records, bulk_save_running_stats, coordinate_key,
+                      existing_record_keys, get_session, query_weather_record, save_running_stats)
+from grid import snap_to_grid
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Accepted header names for each field of an events file
+EVENT_COLUMNS = {
+    'latitude': ('lat', 'latitude'),
+    'longitude': ('lon', 'lng', 'longitude'),
+    'date': ('date',),
+    'lookback': ('lookback', 'years')
+}
+
+
+def event_field(record, field):
+    for name in EVENT_COLUMNS[field]:
+        value = record.get(name)
+        # Blank CSV cells and Parquet nulls (NaN is not equal to itself) count as missing
+        if value is not None and value == value and str(value).strip() != '':
+            return value
+    return None
+
+
+def read_events(path, default_years=5):
+    """
+    Read a CSV or Parquet file of events with lat, lon, date (YYYY-MM-DD) and an optional lookback
+    column. Returns (row number, job) pairs, where each job is a
+    (latitude, longitude, month, day, year, years) tuple for collect_batch.
+    """
+    if path.endswith('.parquet'):
+        import pandas as pd
+        records = pd.read_parquet(path).to_dict('records')
+    else:
+        with open(path, newline='') as events_file:
+            records = list(csv.DictReader(events_file))
+
+    events = []
+    for row, record in enumerate(records):
+        latitude, longitude, date = (event_field(record, field) for field in ('latitude', 'longitude', 'date'))
+        if latitude is None or longitude is None or date is None:
+            raise ValueError(f"Event {row} in {path} needs lat, lon and date")
+        date = datetime.date.fromisoformat(str(date)[:10])
+        lookback = event_field(record, 'lookback')
+        years = int(float(lookback)) if lookback is not None else default_years
+        events.append((row, (float(latitude), float(longitude), date.month, date.day, date.year, years)))
+    return events
+
+
+def event_key(job, grid_resolution=None):
+    """Return the weather_records key the collector will write for a job."""
+    latitude, longitude, month, day, year = job[:5]
+    if grid_resolution:
+        latitude, longitude = snap_to_grid(latitude, longitude, grid_resolution)
+    return coordinate_key(latitude), coordinate_key(longitude), month, day, year
+
+
+def load_checkpoint(path):
+    """
+    Return the (record key, lookback) pairs an earlier run of the same events file already finished.
+    Events are checkpointed by what they collect rather than by row, so editing the file is safe.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path) as checkpoint:
+        return {tuple(int(value) for value in line.split(',')) for line in checkpoint if line.strip()}
+
+
+def append_checkpoint(path, events):
+    with open(path, 'a') as checkpoint:
+        checkpoint.writelines(','.join(str(value) for value in event) + "\n" for event in events)
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+
+
+def run_events(path, years=5, max_workers=8, requests_per_second=5.0, retries=3, flush_every=500,
+               checkpoint_path=None, grid_resolution=None, archive=None, session=None):
+    """
+    Collect every event in a CSV or Parquet file with bounded concurrency and bulk write the
+    results. Events already in weather_records with the same lookback or in the checkpoint file
+    are skipped; records stored before lookbacks were recorded are collected again. Finished
+    events are appended to the checkpoint after each bulk write, so an interrupted run picks up
+    where it stopped. Failed events are not checkpointed and are retried on the next run. weather_records holds one record per key, so a
+    later event with the key of an earlier one is skipped as a duplicate, or, with a different
+    lookback, reported as a conflict. Returns a throughput report.
+    """
+    checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+    session = session or get_session()
+    events = read_events(path, years)
+    finished = load_checkpoint(checkpoint_path)
+    stored = existing_record_keys({job[4] for _, job in events}, session)
+
+    rows_by_job, lookbacks = {}, {}
+    skipped = conflicts = 0
+    for row, job in events:
+        key, lookback = event_key(job, grid_resolution), job[5]
+        if key in lookbacks:
+            if lookbacks[key] != lookback:
+                conflicts += 1
+                logger.warning("Event %d %s asks for a %d-year lookback, but an earlier event for the same "
+                               "record asks for %d; skipping it", row, job, lookback, lookbacks[key])
+            else:
+                skipped += 1
+            continue
+        lookbacks[key] = lookback
+        if stored.get(key) == lookback or key + (lookback,) in finished:
+            skipped += 1
+            continue
+        rows_by_job[job] = row
+
+    report = {'events': len(events), 'skipped': skipped, 'conflicts': conflicts, 'collected': 0, 'failed': 0,
+              'written': 0}
+    collectors, finished_events = [], []
+
+    def flush():
+        if collectors:
+            report['written'] += bulk_add_weather_records(collectors, session)
+            bulk_save_running_stats(collectors, session)
+        append_checkpoint(checkpoint_path, finished_events)
+        collectors.clear()
+        finished_events.clear()
+
+    start = time.perf_counter()
+    for result in collect_batch(rows_by_job, max_workers=max_workers, requests_per_second=requests_per_second,
+                                retries=retries, archive=archive, grid_resolution=grid_resolution):
+        if result.collector is None:
+            report['failed'] += 1
+            logger.warning("Event %d %s failed: %s", rows_by_job[result.job], result.job, result.error)
+            continue
+
+        report['collected'] += 1
+        collectors.append(result.collector)
+        finished_events.append(event_key(result.job, grid_resolution) + (result.job[5],))
+        if len(collectors) >= flush_every:
+            flush()
+            elapsed = time.perf_counter() - start
+            logger.info("%d/%d events collected, %.1f events/sec", report['collected'], len(rows_by_job),
+                        report['collected'] / elapsed)
+    flush()
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    processed = report['collected'] + report['failed']
+    report['events_per_sec'] = round(processed / report['seconds'], 2) if processed else 0.0
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Collect historical weather statistics for one or many events.")
+    parser.add_argument('--events', help="CSV or Parquet file of events (lat, lon, date, optional lookback)")
+    parser.add_argument('--years', type=int, default=5, help="lookback for events without one")
+    parser.add_argument('--workers', type=int, default=8, help="concurrent collector threads")
+    parser.add_argument('--rate', type=float, default=5.0, help="maximum API requests per second")
+    parser.add_argument('--retries', type=int, default=3, help="attempts per event after the first")
+    parser.add_argument('--flush-every', type=int, default=500, help="results per bulk write and checkpoint")
+    parser.add_argument('--checkpoint', help="checkpoint file (default: EVENTS.checkpoint)")
+    parser.add_argument('--grid-resolution', type=float, help="snap locations to this grid in degrees")
+    parser.add_argument('--archive', help="directory of a local weather archive to read from and fill")
+    return parser.parse_args()
+
+
+def run_batch(args):
+    archive = None
+    if args.archive:
+        from archive import WeatherArchive
+        archive = WeatherArchive(args.archive)
+
+    report = run_events(args.events, years=args.years, max_workers=args.workers, requests_per_second=args.rate,
+                        retries=args.retries, flush_every=args.flush_every, checkpoint_path=args.checkpoint,
+                        grid_resolution=args.grid_resolution, archive=archive)
+    print(f"{report['events']} events: {report['collected']} collected, {report['skipped']} skipped, "
+          f"{report['conflicts']} conflicting, {report['failed']} failed")
+    print(f"Wrote {report['written']} records in {report['seconds']}s "
+          f"({report['events_per_sec']} events/sec sustained)")
+
 
 def main():
+    args = parse_args()
+    # Warnings are shown by default; LOG_LEVEL=INFO adds progress and the metrics line, DEBUG every request
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.events:
+        run_batch(args)
+        metrics.log()
+        return
+
     # Initialize the weather data collector for Austin, TX on August 16
     austin_weather = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024)
     austin_weather.fetch_historical_data()
@@ -22,11 +214,16 @@ def main():
         max_wind_speed=austin_weather.max_wind_speed,
         sum_precipitation=austin_weather.sum_precipitation,
         min_precipitation=austin_weather.min_precipitation,
-        max_precipitation=austin_weather.max_precipitation
+        max_precipitation=austin_weather.max_precipitation,
+        lookback=austin_weather.years
     )
 
-    # Add the record to the database
-    add_weather_record(record)
+    session = get_session()
+
+    # Add (or, on a rerun, update) the record, with the accumulators needed to extend it later
+    bulk_add_weather_records([record], session)
+    save_running_stats(record.latitude, record.longitude, record.month, record.day, record.year,
+                       austin_weather.stats, session, austin_weather.sketches)
 
     # Query the record from the database
     queried_record = query_weather_record(
@@ -50,6 +247,11 @@ def main():
         print(f"Sum Precipitation: {queried_record.sum_precipitation} inches")
         print(f"Min Precipitation: {queried_record.min_precipitation} inches")
         print(f"Max Precipitation: {queried_record.max_precipitation} inches")
+        print(f"Temperature p10/p50/p90: {austin_weather.p10_temperature}°F / "
+              f"{austin_weather.p50_temperature}°F / {austin_weather.p90_temperature}°F")
+        print(f"Chance of 0.1 inches of rain or more: {austin_weather.rain_probability}")
+
+    metrics.log()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """
+    Thread-safe pipeline instrumentation: wall time per named phase (calls, total and slowest)
+    and plain counters such as bytes received, retries, cache hits and rows written.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        self._phases = {}
+
+    def increment(self, name: str, amount: int = 1):
+        if amount:
+            with self._lock:
+                self._counters[name] += amount
+
+    def record_phase(self, name: str, seconds: float):
+        with self._lock:
+            calls, total, slowest = self._phases.get(name, (0, 0.0, 0.0))
+            self._phases[name] = (calls + 1, total + seconds, max(slowest, seconds))
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - start)
+
+    def timed(self, name: str):
+        """Decorator that records every call of the wrapped function under phase `name`."""
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def snapshot(self):
+        """Return the counters and per-phase timings as a plain, JSON-serializable dict."""
+        with self._lock:
+            phases = {
+                name: {
+                    "calls": calls,
+                    "seconds": round(total, 6),
+                    "mean_ms": round(total / calls * 1000, 3),
+                    "max_ms": round(slowest * 1000, 3)
+                }
+                for name, (calls, total, slowest) in self._phases.items()
+            }
+            return {"phases": phases, "counters": dict(self._counters)}
+
+    def log_line(self):
+        """Format the snapshot as one key=value line, phases first."""
+        snapshot = self.snapshot()
+        fields = [f"{name}={phase['calls']}x/{phase['seconds']:.3f}s"
+                  for name, phase in sorted(snapshot["phases"].items())]
+        fields += [f"{name}={value}" for name, value in sorted(snapshot["counters"].items())]
+        return " ".join(fields)
+
+    def log(self, level=logging.INFO):
+        if logger.isEnabledFor(level):
+            logger.log(level, "metrics %s", self.log_line())
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._phases.clear()
+
+
+# Process-wide registry shared by the collector, HTTP client and database layers
+metrics = Metrics()
@@ -1,57 +1,252 @@
+import contextvars
+import logging
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+
 import openmeteo_requests
-import requests_cache
-import pandas as pd
+import numpy as np
 from retry_requests import retry
 
-# Setup the Open-Meteo API client with cache and retry on error
-cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
+from cache import CachePolicy, WeatherCacheSession
+from hourly import HOUR_BANDS, ROLLING_HOURS, aggregate_hourly, day_matrix
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Setup the Open-Meteo API client with a size-bounded cache and retry on error
+cache_session = WeatherCacheSession('.cache', policy=CachePolicy())
 retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
 openmeteo = openmeteo_requests.Client(session=retry_session)
 
+# Point OPENMETEO_ARCHIVE_URL at a mirror or local stand-in (see standin.py) to avoid the public API
+ARCHIVE_URL = os.environ.get("OPENMETEO_ARCHIVE_URL", "https://archive-api.open-meteo.com/v1/archive")
+
+DAILY_VARIABLES = [
+    "temperature_2m_max",
+    "temperature_2m_min",
+    "temperature_2m_mean",
+    "precipitation_sum",
+    "wind_speed_10m_max"
+]
+
+# Upper bound on coordinates packed into a single archive request
+MAX_LOCATIONS_PER_REQUEST = 100
+
+# Rate limiter (anything with acquire()) that every archive request waits on. The batch collector
+# sets it on each worker thread for the duration of a job; unset, requests are not throttled.
+request_limiter = contextvars.ContextVar("request_limiter", default=None)
+
+
+def throttle():
+    limiter = request_limiter.get()
+    if limiter is not None:
+        limiter.acquire()
+
+
+class DailySeries(namedtuple("DailySeries", ["time", "time_end", "interval"] + DAILY_VARIABLES)):
+    """
+    Decoded daily block of one response: epoch seconds of the first and one-past-last day, the
+    step in seconds, and one float32 array per variable viewing the response buffer directly.
+    """
+    __slots__ = ()
 
-def fetch_weather_data(latitude, longitude, start_date, end_date):
-    url = "https://archive-api.open-meteo.com/v1/archive"
+    def to_array(self):
+        """Return the variables as one (day, variable) array in DAILY_VARIABLES order."""
+        return np.column_stack([getattr(self, variable) for variable in DAILY_VARIABLES])
+
+
+# Decoded hourly block: epoch start, end and step like DailySeries, the requested hourly
+# variable names, and one float32 array per variable viewing the response buffer
+HourlySeries = namedtuple("HourlySeries", ["time", "time_end", "interval", "variables", "values"])
+
+
+def archive_params(latitude, longitude, start_date, end_date, hourly=None, daily=True):
     params = {
         "latitude": latitude,
         "longitude": longitude,
         "start_date": start_date,
         "end_date": end_date,
-        "daily": [
-            "temperature_2m_max",
-            "temperature_2m_min",
-            "temperature_2m_mean",
-            "precipitation_sum",
-            "wind_speed_10m_max"
-        ],
         "temperature_unit": "fahrenheit",
         "wind_speed_unit": "mph",
         "precipitation_unit": "inch",
         "timezone": "America/Chicago"
     }
+    if daily:
+        params["daily"] = DAILY_VARIABLES
+    if hourly:
+        params["hourly"] = list(hourly)
+    return params
+
 
-    responses = openmeteo.weather_api(url, params=params)
+def fetch_weather_data(latitude, longitude, start_date, end_date, hourly=None, daily=True):
+    """
+    Fetch the daily variables for one location, plus the given hourly variables if any.
+    Pass daily=False to fetch only the hourly variables.
+    The request first waits for a slot from the current request_limiter, if one is set.
+    """
+    logger.debug("Fetching %s..%s for %s, %s", start_date, end_date, latitude, longitude)
+    params = archive_params(latitude, longitude, start_date, end_date, hourly, daily)
+    throttle()
+    with metrics.phase("fetch"):
+        responses = openmeteo.weather_api(ARCHIVE_URL, params=params)
     return responses[0]
 
 
-def process_daily_data(response):
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller runs the function and every
+    caller that arrives while it is in flight waits for and shares its result (or exception).
+    Nothing is cached once the call completes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = function(*args)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+daily_requests = SingleFlight()
+
+
+def fetch_and_decode_daily(latitude, longitude, start_date, end_date):
+    response = fetch_weather_data(latitude, longitude, start_date, end_date)
+    values = decode_daily_data(response).to_array()
+    # The array is shared by every coalesced caller, so keep it read-only
+    values.setflags(write=False)
+    return values
+
+
+def fetch_daily_values(latitude, longitude, start_date, end_date):
+    """
+    Fetch and decode the daily variables for one location as a read-only (day, variable) array.
+    Identical requests that are already in flight on another thread are not sent again; the
+    callers share the first one's decoded result.
+    """
+    key = (f"{latitude:.4f}", f"{longitude:.4f}", str(start_date), str(end_date))
+    return daily_requests.do(key, fetch_and_decode_daily, latitude, longitude, str(start_date), str(end_date))
+
+
+def fetch_weather_data_batch(latitudes, longitudes, start_date, end_date,
+                             max_locations=MAX_LOCATIONS_PER_REQUEST):
+    """
+    Fetch the same date range for many locations, packing up to max_locations coordinates
+    into each request as comma-separated lists. Returns one response per location, in input order.
+    Each request waits for a slot from the current request_limiter, if one is set.
+    """
+    if len(latitudes) != len(longitudes):
+        raise ValueError("latitudes and longitudes must have the same length")
+
+    responses = []
+    for i in range(0, len(latitudes), max_locations):
+        params = archive_params(
+            ",".join(str(lat) for lat in latitudes[i:i + max_locations]),
+            ",".join(str(lon) for lon in longitudes[i:i + max_locations]),
+            start_date,
+            end_date
+        )
+        throttle()
+        with metrics.phase("fetch"):
+            responses.extend(openmeteo.weather_api(ARCHIVE_URL, params=params))
+    return responses
+
+
+@metrics.timed("decode")
+def stack_daily_data(responses):
+    """
+    Decode the daily variables of several responses into one float32 array shaped
+    (location, day, variable), with variables in DAILY_VARIABLES order.
+    """
+    if not responses:
+        return np.empty((0, 0, len(DAILY_VARIABLES)), dtype=np.float32)
+
+    days = responses[0].Daily().Variables(0).ValuesLength()
+    stacked = np.empty((len(responses), days, len(DAILY_VARIABLES)), dtype=np.float32)
+    for i, response in enumerate(responses):
+        daily = response.Daily()
+        for j in range(len(DAILY_VARIABLES)):
+            stacked[i, :, j] = daily.Variables(j).ValuesAsNumpy()
+    return stacked
+
+
+@metrics.timed("decode")
+def decode_daily_data(response):
+    """
+    Decode the daily block of a response without building any pandas objects.
+    """
     daily = response.Daily()
-    daily_temperature_2m_max = daily.Variables(0).ValuesAsNumpy()
-    daily_temperature_2m_min = daily.Variables(1).ValuesAsNumpy()
-    daily_temperature_2m_mean = daily.Variables(2).ValuesAsNumpy()
-    daily_precipitation_sum = daily.Variables(3).ValuesAsNumpy()
-    daily_wind_speed_10m_max = daily.Variables(4).ValuesAsNumpy()
+    return DailySeries(
+        daily.Time(),
+        daily.TimeEnd(),
+        daily.Interval(),
+        *(daily.Variables(j).ValuesAsNumpy() for j in range(len(DAILY_VARIABLES)))
+    )
+
+
+@metrics.timed("decode")
+def decode_hourly_data(response, variables):
+    """
+    Decode the hourly block of a response fetched with hourly=variables, without copying the values.
+    """
+    hourly = response.Hourly()
+    return HourlySeries(
+        hourly.Time(),
+        hourly.TimeEnd(),
+        hourly.Interval(),
+        tuple(variables),
+        tuple(hourly.Variables(j).ValuesAsNumpy() for j in range(len(variables)))
+    )
 
+
+@metrics.timed("dataframe")
+def process_daily_data(response, hourly=None, bands=HOUR_BANDS, hours=(), rolling_hours=ROLLING_HOURS):
+    """
+    Decode the daily block of a response into a DataFrame with a date column. Pandas is only
+    imported here, so callers that use decode_daily_data never pay for it.
+
+    If the response was fetched with hourly variables, pass the same list as `hourly` to add
+    per-day aggregates of each one ({variable}_{band}, {variable}_{hour}h and
+    {variable}_rolling_max_{n}h columns); the hourly values never become DataFrame rows.
+    """
+    import pandas as pd
+
+    series = decode_daily_data(response)
     daily_data = {"date": pd.date_range(
-        start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-        end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-        freq=pd.Timedelta(seconds=daily.Interval()),
+        start=pd.to_datetime(series.time, unit="s", utc=True),
+        end=pd.to_datetime(series.time_end, unit="s", utc=True),
+        freq=pd.Timedelta(seconds=series.interval),
         inclusive="left"
     )}
-    daily_data["temperature_2m_max"] = daily_temperature_2m_max
-    daily_data["temperature_2m_min"] = daily_temperature_2m_min
-    daily_data["temperature_2m_mean"] = daily_temperature_2m_mean
-    daily_data["precipitation_sum"] = daily_precipitation_sum
-    daily_data["wind_speed_10m_max"] = daily_wind_speed_10m_max
+    for variable in DAILY_VARIABLES:
+        daily_data[variable] = getattr(series, variable)
+
+    if hourly:
+        hourly_series = decode_hourly_data(response, hourly)
+        for variable, values in zip(hourly_series.variables, hourly_series.values):
+            for name, per_day in aggregate_hourly(day_matrix(values), bands, hours, rolling_hours).items():
+                daily_data[f"{variable}_{name}"] = per_day
 
     daily_dataframe = pd.DataFrame(data=daily_data)
     return daily_dataframe
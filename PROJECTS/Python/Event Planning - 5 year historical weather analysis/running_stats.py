@@ -0,0 +1,109 @@
+import math
+
+import numpy as np
+
+
+class RunningStats:
+    """
+    Mergeable accumulator of count, sum, minimum, maximum and mean/variance (Welford) for one
+    variable. Adding a value is O(1), and accumulators built over separate shards or years
+    merge into the same result as one built over all of the values.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=math.inf, maximum=-math.inf, total=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+        self.total = total
+
+    def update(self, value):
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        self.total += value
+
+    def update_many(self, values):
+        """
+        Add an array of values at once by summarizing it and merging the summary.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        mean = float(values.mean())
+        self.merge(RunningStats(
+            count=int(values.size),
+            mean=mean,
+            m2=float(((values - mean) ** 2).sum()),
+            minimum=float(values.min()),
+            maximum=float(values.max()),
+            total=float(values.sum())
+        ))
+
+    def merge(self, other):
+        """
+        Fold another accumulator into this one (Chan et al. parallel update) and return self.
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.minimum, self.maximum, self.total = other.minimum, other.maximum, other.total
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.total += other.total
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else math.nan
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'm2': self.m2,
+            'minimum': self.minimum,
+            'maximum': self.maximum,
+            'total': self.total
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{name: values[name] for name in ('count', 'mean', 'm2', 'minimum', 'maximum', 'total')})
+
+
+def summarize(stats):
+    """
+    Turn per-variable accumulators (keyed by Open-Meteo daily variable) into the WeatherRecord
+    statistic columns, rounded to 2 decimal places. Columns without data are None.
+    """
+    def value(variable, attribute):
+        accumulator = stats.get(variable)
+        if accumulator is None or accumulator.count == 0:
+            return None
+        return round(float(getattr(accumulator, attribute)), 2)
+
+    return {
+        'avg_temperature': value('temperature_2m_mean', 'mean'),
+        'min_temperature': value('temperature_2m_min', 'minimum'),
+        'max_temperature': value('temperature_2m_max', 'maximum'),
+        'avg_wind_speed': value('wind_speed_10m_max', 'mean'),
+        'min_wind_speed': value('wind_speed_10m_max', 'minimum'),
+        'max_wind_speed': value('wind_speed_10m_max', 'maximum'),
+        'sum_precipitation': value('precipitation_sum', 'total'),
+        'min_precipitation': value('precipitation_sum', 'minimum'),
+        'max_precipitation': value('precipitation_sum', 'maximum')
+    }
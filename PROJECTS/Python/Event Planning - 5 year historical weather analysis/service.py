@@ -0,0 +1,187 @@
+import argparse
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+from sqlalchemy import event, make_url, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from database import (RECORD_KEY, STATISTIC_COLUMNS, Base, WeatherRecord, coordinate_key, migrate_tables,
+                      set_sqlite_pragmas)
+
+ASYNC_DATABASE_URL = 'sqlite+aiosqlite:///weather_data.db'
+
+# Largest number of keys one batch request may ask for, and keys per IN query
+MAX_BATCH_KEYS = 1000
+LOOKUP_CHUNK = 200
+
+RECORD_COLUMNS = ['latitude', 'longitude', 'month', 'day', 'year'] + STATISTIC_COLUMNS
+
+
+class HotKeyCache:
+    """
+    Small LRU of serialized records by key. Entries expire after `ttl` seconds so records
+    written by other processes show up; misses (None) are cached too.
+    """
+
+    def __init__(self, max_entries=4096, ttl=30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, key, record):
+        self._entries[key] = (time.monotonic() + self.ttl, record)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+CACHE = web.AppKey('cache', HotKeyCache)
+ENGINE = web.AppKey('engine', AsyncEngine)
+
+
+def parse_key(values):
+    """
+    Turn lat, lon, month, day and year from a query string or JSON object into a record key.
+    """
+    try:
+        return (coordinate_key(float(values['lat'])), coordinate_key(float(values['lon'])),
+                int(values['month']), int(values['day']), int(values['year']))
+    except (KeyError, TypeError, ValueError):
+        raise web.HTTPBadRequest(text="Each key needs numeric lat, lon, month, day and year")
+
+
+def json_response(request, payload):
+    """
+    Serialize a payload with a strong ETag and answer 304 when the client already holds it.
+    """
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='application/json', headers=headers)
+
+
+async def lookup(app, keys):
+    """
+    Return the record dict (or None) for every key, serving hot keys from the cache and the
+    rest with chunked (key) IN (...) queries on the indexed lookup key.
+    """
+    cache = app[CACHE]
+    found = {}
+    missing = []
+    for key in dict.fromkeys(keys):
+        hit, record = cache.get(key)
+        if hit:
+            found[key] = record
+        else:
+            missing.append(key)
+    if not missing:
+        return [found[key] for key in keys]
+
+    key_columns = tuple_(*(getattr(WeatherRecord, column) for column in RECORD_KEY))
+    record_columns = [getattr(WeatherRecord, column) for column in RECORD_KEY + RECORD_COLUMNS]
+    async with app[ENGINE].connect() as connection:
+        for i in range(0, len(missing), LOOKUP_CHUNK):
+            chunk = missing[i:i + LOOKUP_CHUNK]
+            result = await connection.execute(select(*record_columns).where(key_columns.in_(chunk)))
+            for row in result:
+                found[tuple(row[:len(RECORD_KEY)])] = dict(zip(RECORD_COLUMNS, row[len(RECORD_KEY):]))
+
+    for key in missing:
+        record = found.setdefault(key, None)
+        cache.put(key, record)
+    return [found[key] for key in keys]
+
+
+async def get_record(request):
+    """GET /records?lat=&lon=&month=&day=&year= returns one record, or 404."""
+    record, = await lookup(request.app, [parse_key(request.query)])
+    if record is None:
+        raise web.HTTPNotFound(text="No record for that location and date")
+    return json_response(request, record)
+
+
+async def get_records_batch(request):
+    """
+    POST /records/batch with {"keys": [{"lat", "lon", "month", "day", "year"}, ...]} returns
+    {"records": [...]} in key order, with null for keys that have no record.
+    """
+    try:
+        keys = (await request.json())['keys']
+    except (ValueError, KeyError, TypeError):
+        raise web.HTTPBadRequest(text='Expected a JSON body {"keys": [...]}')
+    if not isinstance(keys, list) or len(keys) > MAX_BATCH_KEYS:
+        raise web.HTTPBadRequest(text=f"keys must be a list of at most {MAX_BATCH_KEYS} objects")
+    return json_response(request, {'records': await lookup(request.app, [parse_key(key) for key in keys])})
+
+
+async def get_stats(request):
+    cache = request.app[CACHE]
+    return web.json_response({'cache_hits': cache.hits, 'cache_misses': cache.misses,
+                              'cache_entries': len(cache)})
+
+
+def create_app(url=ASYNC_DATABASE_URL, pool_size=8, cache_entries=4096, cache_ttl=30.0):
+    """
+    Build the read service over a weather database. The async engine keeps up to pool_size
+    connections open, and SQLite connections get the same WAL pragmas as database.py. On startup
+    the schema is created if missing and migrated like database.configure() does, so the service
+    can run against a database written by an older version.
+    """
+    app = web.Application()
+    app[CACHE] = HotKeyCache(cache_entries, cache_ttl)
+
+    async def open_engine(app):
+        if make_url(url).get_backend_name() == 'sqlite':
+            # aiosqlite defaults to opening a connection per checkout; keep a pool of them instead
+            engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=pool_size)
+            event.listen(engine.sync_engine, 'connect', set_sqlite_pragmas)
+        else:
+            engine = create_async_engine(url, pool_size=pool_size)
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+            await connection.run_sync(migrate_tables)
+        app[ENGINE] = engine
+        yield
+        await engine.dispose()
+
+    app.cleanup_ctx.append(open_engine)
+    app.router.add_get('/records', get_record)
+    app.router.add_post('/records/batch', get_records_batch)
+    app.router.add_get('/stats', get_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve weather records over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--database', default=ASYNC_DATABASE_URL, help="async SQLAlchemy database URL")
+    parser.add_argument('--pool-size', type=int, default=8)
+    parser.add_argument('--cache-ttl', type=float, default=30.0, help="seconds a cached record is served")
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.database, args.pool_size, cache_ttl=args.cache_ttl),
+                host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import zlib
+
+import numpy as np
+
+# Fixed bin layout per daily variable: (low edge, high edge, bin width). Values outside the
+# range land in the first or last bin. Precipitation bins are 0.01 in wide, so threshold
+# probabilities such as "more than 0.1 in" fall exactly on a bin edge.
+BIN_LAYOUTS = {
+    "temperature_2m_max": (-60.0, 140.0, 0.5),
+    "temperature_2m_min": (-60.0, 140.0, 0.5),
+    "temperature_2m_mean": (-60.0, 140.0, 0.5),
+    "precipitation_sum": (0.0, 10.0, 0.01),
+    "wind_speed_10m_max": (0.0, 150.0, 0.5),
+}
+
+
+class HistogramSketch:
+    """
+    Mergeable fixed-bin histogram for approximate percentiles over any number of values in
+    constant memory. Sketches with the same layout merge by adding their bin counts, and they
+    serialize to a compact byte string for storage in SQLite.
+    """
+
+    def __init__(self, low: float, high: float, width: float, counts=None):
+        self.low = low
+        self.high = high
+        self.width = width
+        bins = int(round((high - low) / width))
+        self.counts = np.zeros(bins, dtype=np.uint32) if counts is None else counts
+
+    @classmethod
+    def for_variable(cls, variable: str):
+        return cls(*BIN_LAYOUTS[variable])
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def bin_indices(self, values):
+        """
+        Return the bin index of each value, clipping out-of-range values to the end bins.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        return np.clip(((values - self.low) / self.width).astype(np.int64), 0, len(self.counts) - 1)
+
+    def update_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        bins = self.bin_indices(values[~np.isnan(values)])
+        self.counts += np.bincount(bins, minlength=len(self.counts)).astype(np.uint32)
+
+    def merge(self, other):
+        if (other.low, other.high, other.width) != (self.low, self.high, self.width):
+            raise ValueError("Only sketches with the same bin layout can be merged")
+        self.counts += other.counts
+        return self
+
+    def quantile(self, q: float):
+        """
+        Return the approximate q-quantile (0 <= q <= 1), interpolated within its bin, so the
+        error is at most one bin width. Returns None for an empty sketch.
+        """
+        total = self.count
+        if total == 0:
+            return None
+        cumulative = np.cumsum(self.counts)
+        target = q * total
+        index = int(np.searchsorted(cumulative, target, side="left"))
+        index = min(index, len(self.counts) - 1)
+        below = cumulative[index - 1] if index else 0
+        fraction = (target - below) / self.counts[index] if self.counts[index] else 0.0
+        return self.low + (index + fraction) * self.width
+
+    def fraction_above(self, threshold: float):
+        """
+        Return the share of values at or above a threshold on a bin edge (for example the
+        probability of 0.1 in of rain or more). Returns None for an empty sketch.
+        """
+        total = self.count
+        if total == 0:
+            return None
+        first = int(np.ceil((threshold - self.low) / self.width - 1e-9))
+        return float(self.counts[max(first, 0):].sum()) / total
+
+    def to_bytes(self):
+        """
+        Serialize the bin counts, zlib-compressed since most bins are empty. The layout is not
+        stored; it comes from BIN_LAYOUTS on load.
+        """
+        return zlib.compress(self.counts.astype("<u4").tobytes())
+
+    @classmethod
+    def from_bytes(cls, variable: str, data: bytes):
+        low, high, width = BIN_LAYOUTS[variable]
+        counts = np.frombuffer(zlib.decompress(data), dtype="<u4").astype(np.uint32)
+        return cls(low, high, width, counts)
+
+
+def summarize_sketches(sketches):
+    """
+    Return the percentiles planners ask for from per-variable sketches: p10/p50/p90 of the daily
+    mean temperature and the probability of at least 0.1 in of rain. Values are rounded to 2
+    decimal places and None where there is no data.
+    """
+    def rounded(value):
+        return None if value is None else round(float(value), 2)
+
+    temperature = sketches["temperature_2m_mean"]
+    return {
+        'p10_temperature': rounded(temperature.quantile(0.1)),
+        'p50_temperature': rounded(temperature.quantile(0.5)),
+        'p90_temperature': rounded(temperature.quantile(0.9)),
+        'rain_probability': rounded(sketches["precipitation_sum"].fraction_above(0.1))
+    }
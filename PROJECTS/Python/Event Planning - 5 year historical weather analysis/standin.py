@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import flatbuffers
+import numpy as np
+
+# Field slots of the Open-Meteo FlatBuffer schema (openmeteo_sdk) that the decoder reads
+RESPONSE_FIELDS = 16
+RESPONSE_LATITUDE, RESPONSE_LONGITUDE, RESPONSE_LOCATION_ID, RESPONSE_DAILY, RESPONSE_HOURLY = 0, 1, 4, 10, 11
+SERIES_FIELDS = 4
+SERIES_TIME, SERIES_TIME_END, SERIES_INTERVAL, SERIES_VARIABLES = 0, 1, 2, 3
+VARIABLE_FIELDS = 12
+VARIABLE_VALUES = 3
+
+SECONDS_PER_HOUR = 3600
+SECONDS_PER_DAY = 86400
+
+
+def encode_series(builder, start, interval, columns):
+    """Write a VariablesWithTime table holding one float32 VariableWithValues per column."""
+    variables = []
+    for column in columns:
+        values = builder.CreateNumpyVector(np.asarray(column, dtype=np.float32))
+        builder.StartObject(VARIABLE_FIELDS)
+        builder.PrependUOffsetTRelativeSlot(VARIABLE_VALUES, values, 0)
+        variables.append(builder.EndObject())
+
+    builder.StartVector(4, len(variables), 4)
+    for variable in reversed(variables):
+        builder.PrependUOffsetTRelative(variable)
+    vector = builder.EndVector()
+
+    builder.StartObject(SERIES_FIELDS)
+    builder.PrependInt64Slot(SERIES_TIME, start, 0)
+    builder.PrependInt64Slot(SERIES_TIME_END, start + len(columns[0]) * interval, 0)
+    builder.PrependInt32Slot(SERIES_INTERVAL, interval, 0)
+    builder.PrependUOffsetTRelativeSlot(SERIES_VARIABLES, vector, 0)
+    return builder.EndObject()
+
+
+def encode_response(latitude, longitude, start, daily, location_id=0, hourly=None):
+    """
+    Encode one location as a length-prefixed WeatherApiResponse, the framing the archive API
+    uses for each location of a multi-location body.
+    """
+    builder = flatbuffers.Builder(1024)
+    series = encode_series(builder, start, SECONDS_PER_DAY, daily) if daily else None
+    hourly_series = encode_series(builder, start, SECONDS_PER_HOUR, hourly) if hourly else None
+    builder.StartObject(RESPONSE_FIELDS)
+    builder.PrependFloat32Slot(RESPONSE_LATITUDE, latitude, 0)
+    builder.PrependFloat32Slot(RESPONSE_LONGITUDE, longitude, 0)
+    builder.PrependInt64Slot(RESPONSE_LOCATION_ID, location_id, 0)
+    if series is not None:
+        builder.PrependUOffsetTRelativeSlot(RESPONSE_DAILY, series, 0)
+    if hourly_series is not None:
+        builder.PrependUOffsetTRelativeSlot(RESPONSE_HOURLY, hourly_series, 0)
+    builder.Finish(builder.EndObject())
+    body = bytes(builder.Output())
+    return len(body).to_bytes(4, "little") + body
+
+
+def synthetic_daily(latitude, start_date, end_date, variables):
+    """
+    Deterministic daily series for a location: a seasonal temperature cycle that cools with
+    latitude, a weekly rain pattern and a steady breeze. Returns one float32 column per variable.
+    """
+    days = np.arange(np.datetime64(start_date, "D"), np.datetime64(end_date, "D") + 1)
+    day_of_year = (days - days.astype("datetime64[Y]")).astype(np.int64)
+    season = np.cos(2 * np.pi * (day_of_year - 200) / 365.25)
+    mean = 85.0 - (latitude - 30.0) * 1.5 + 15.0 * season
+    generated = {
+        "temperature_2m_max": mean + 10.0,
+        "temperature_2m_min": mean - 10.0,
+        "temperature_2m_mean": mean,
+        "precipitation_sum": np.where(day_of_year % 7 == 0, 0.4, 0.0),
+        "wind_speed_10m_max": 8.0 + day_of_year % 5
+    }
+    return days, [generated.get(variable, np.zeros(len(days))).astype(np.float32) for variable in variables]
+
+
+def synthetic_hourly(latitude, start_date, end_date, variables):
+    """
+    Hourly companion of synthetic_daily: each day's mean temperature with a diurnal swing of
+    10 degrees peaking at 15:00, rain in the early morning of rainy days, and a steady breeze.
+    """
+    days, daily = synthetic_daily(latitude, start_date, end_date, ["temperature_2m_mean", "precipitation_sum"])
+    hour = np.tile(np.arange(24), len(days))
+    swing = 10.0 * np.cos(2 * np.pi * (hour - 15) / 24)
+    generated = {
+        "temperature_2m": np.repeat(daily[0], 24) + swing,
+        "precipitation": np.where(hour < 4, np.repeat(daily[1], 24) / 4, 0.0),
+        "wind_speed_10m": 8.0 + hour % 3
+    }
+    return [generated.get(variable, np.zeros(len(hour))).astype(np.float32) for variable in variables]
+
+
+class StandInArchive:
+    """
+    Local stand-in for the Open-Meteo archive API. Serves FlatBuffer daily (and hourly) responses on a
+    loopback port, answering from recorded bodies when `recordings` holds one for the request
+    ({latitude:.4f}_{longitude:.4f}_{start_date}_{end_date}.bin, a single-location body saved from
+    the real API) and from synthetic series otherwise. `latency` seconds are added per request.
+    """
+
+    def __init__(self, recordings=None, latency=0.0):
+        self.recordings = recordings
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1/archive"
+
+    def recording_path(self, latitude, longitude, start_date, end_date):
+        return os.path.join(self.recordings, f"{latitude:.4f}_{longitude:.4f}_{start_date}_{end_date}.bin")
+
+    def body(self, query):
+        latitudes = [float(value) for value in query["latitude"][0].split(",")]
+        longitudes = [float(value) for value in query["longitude"][0].split(",")]
+        start_date, end_date = query["start_date"][0], query["end_date"][0]
+        variables = [variable for value in query.get("daily", []) for variable in value.split(",")]
+        hourly_variables = [variable for value in query.get("hourly", []) for variable in value.split(",")]
+
+        chunks = []
+        for location_id, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+            if self.recordings:
+                path = self.recording_path(latitude, longitude, start_date, end_date)
+                if os.path.exists(path):
+                    with open(path, "rb") as recorded:
+                        chunks.append(recorded.read())
+                    continue
+            days, daily = synthetic_daily(latitude, start_date, end_date, variables)
+            # An hourly-only request leaves out the daily block, as the real archive does
+            daily = daily if variables else None
+            start = int(days[0].astype("datetime64[s]").astype(np.int64))
+            hourly = synthetic_hourly(latitude, start_date, end_date, hourly_variables) if hourly_variables else None
+            chunks.append(encode_response(latitude, longitude, start, daily, location_id, hourly))
+        return b"".join(chunks)
+
+    def start(self):
+        archive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with archive._lock:
+                    archive.requests += 1
+                if archive.latency:
+                    time.sleep(archive.latency)
+                try:
+                    body = archive.body(parse_qs(urlparse(self.path).query))
+                except (KeyError, ValueError) as e:
+                    self.send_error(400, str(e))
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
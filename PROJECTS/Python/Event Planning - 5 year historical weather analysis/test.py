@@ -1,7 +1,39 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from sqlalchemy import create_engine
+from datetime import date, timedelta
+from unittest import mock
+import numpy as np
+import openmeteo_requests
+import requests
+from requests.adapters import BaseAdapter
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
-from database import Base, WeatherRecord, add_weather_record, query_weather_record
+from database import (Base, CLIMATOLOGY_SKETCHES, STATISTIC_COLUMNS, WeatherRecord, add_weather_record,
+                      aggregate_bounding_box, aggregate_month, bulk_add_climatology, bulk_add_weather_records,
+                      extend_weather_record, load_running_stats, migrate_database, query_bounding_box, query_climatology, query_month,
+                      query_weather_record, record_key_filter, save_running_stats)
+import batch
+import benchmark
+import main
+import database
+import openmeteo
+import service
+from archive import WeatherArchive
+from cache import CachePolicy, WeatherCacheSession, expire_after_for
+from climatology import build_climatology
+from aiohttp.test_utils import TestClient, TestServer
+from grid import snap_to_grid
+from hourly import aggregate_hourly, day_matrix
+from metrics import Metrics
+from running_stats import RunningStats
+from sketch import HistogramSketch
+from standin import StandInArchive, synthetic_daily
+from WeatherDataCollector import WeatherDataCollector
 
 
 class TestWeatherData(unittest.TestCase):
@@ -75,17 +107,935 @@ class TestWeatherData(unittest.TestCase):
         add_weather_record(record, self.session)
 
         # Query the database using the custom query method
-        queried_record = query_weather_record(30.2672, -97.7431, 8, 16, 2023)
+        queried_record = query_weather_record(30.2672, -97.7431, 8, 16, 2023, session=self.session)
 
         self.assertIsNotNone(queried_record, "Record should be found in the database.")
         self.assertEqual(queried_record.avg_temperature, 85.20)
         self.assertEqual(queried_record.max_wind_speed, 11.80)
 
+    def test_bulk_upsert_updates_existing_keys(self):
+        # Rerunning a bulk load over the same keys updates rows instead of duplicating them
+        rows = [
+            dict(latitude=40.7128, longitude=-74.0060, month=7, day=day, year=2024,
+                 avg_temperature=80.0, min_temperature=70.0, max_temperature=90.0,
+                 avg_wind_speed=8.0, min_wind_speed=5.0, max_wind_speed=12.0,
+                 sum_precipitation=0.2, min_precipitation=0.0, max_precipitation=0.1)
+            for day in range(1, 8)
+        ]
+        bulk_add_weather_records(rows, self.session, chunk_size=3)
+
+        rows[0]['avg_temperature'] = 81.5
+        bulk_add_weather_records(rows, self.session, chunk_size=3)
+
+        records = self.session.query(WeatherRecord).filter_by(latitude=40.7128, longitude=-74.0060)
+        self.assertEqual(records.count(), 7)
+        self.assertEqual(records.filter_by(day=1).one().avg_temperature, 81.5)
+
+    def test_lookup_uses_key_index(self):
+        # The five-column lookup is answered from the unique index, not a table scan
+        query = self.session.query(WeatherRecord).filter_by(
+            **record_key_filter(30.2672, -97.7431, 8, 16, 2024)
+        )
+        statement = query.statement.compile(self.engine)
+        with self.engine.connect() as connection:
+            plan = connection.exec_driver_sql(
+                f"EXPLAIN QUERY PLAN {statement}", tuple(statement.params[name] for name in statement.positiontup)
+            ).fetchall()
+
+        details = " ".join(row[-1] for row in plan)
+        self.assertIn("USING INDEX ix_weather_records_key", details)
+        self.assertNotIn("SCAN", details)
+
+    def test_nearby_float_coordinates_share_a_key(self):
+        # Float noise below the key precision still finds the same record
+        self.assertEqual(record_key_filter(30.2672, -97.7431, 8, 16, 2024),
+                         record_key_filter(30.26720000001, -97.74309999999, 8, 16, 2024))
+
     def test_missing_data_handling(self):
         # Test querying for a record that doesn't exist
-        queried_record = query_weather_record(30.2672, -97.7431, 8, 16, 2022)
+        queried_record = query_weather_record(30.2672, -97.7431, 8, 16, 2022, session=self.session)
         self.assertIsNone(queried_record, "Should return None when no record is found.")
 
 
+def create_legacy_weather_table(engine):
+    """Create weather_records as it was before the scaled key columns and unique index."""
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE weather_records (id INTEGER PRIMARY KEY, latitude FLOAT NOT NULL, "
+            "longitude FLOAT NOT NULL, month INTEGER NOT NULL, day INTEGER NOT NULL, year INTEGER NOT NULL, "
+            "avg_temperature FLOAT, min_temperature FLOAT, max_temperature FLOAT, avg_wind_speed FLOAT, "
+            "min_wind_speed FLOAT, max_wind_speed FLOAT, sum_precipitation FLOAT, min_precipitation FLOAT, "
+            "max_precipitation FLOAT)"
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO weather_records (latitude, longitude, month, day, year, avg_temperature) "
+            "VALUES (30.2672, -97.7431, 8, 16, 2024, 87.0), (30.2672, -97.7431, 8, 16, 2024, 88.0), "
+            "(30.2672, -97.7431, 8, 16, 2023, 85.2)"
+        )
+
+
+class TestDatabaseMigration(unittest.TestCase):
+
+    def test_legacy_table_is_keyed_deduplicated_and_indexed(self):
+        # A table from before the key columns existed gains them, loses duplicates and gets the index
+        engine = create_engine('sqlite:///:memory:')
+        create_legacy_weather_table(engine)
+
+        migrate_database(engine)
+        migrate_database(engine)
+
+        with engine.connect() as connection:
+            rows = connection.exec_driver_sql(
+                "SELECT latitude_key, longitude_key, year, avg_temperature FROM weather_records ORDER BY year"
+            ).fetchall()
+            indexes = [row[1] for row in connection.exec_driver_sql("PRAGMA index_list(weather_records)")]
+
+        self.assertEqual(rows, [(302672, -977431, 2023, 85.2), (302672, -977431, 2024, 88.0)])
+        self.assertIn("ix_weather_records_key", indexes)
+
+    def test_bulk_upsert_migrates_a_legacy_table_first(self):
+        # A session on an unmigrated database still gets a working ON CONFLICT upsert
+        engine = create_engine('sqlite:///:memory:')
+        create_legacy_weather_table(engine)
+        session = sessionmaker(bind=engine)()
+        row = dict(latitude=30.2672, longitude=-97.7431, month=8, day=16, year=2024,
+                   **{column: 90.0 for column in STATISTIC_COLUMNS})
+
+        bulk_add_weather_records([row], session)
+
+        records = session.query(WeatherRecord).filter_by(year=2024).all()
+        self.assertEqual([record.avg_temperature for record in records], [90.0])
+        session.close()
+
+    def test_indexed_table_is_not_scanned_again(self):
+        # Once the unique index exists, later runs skip the backfill and duplicate sweep
+        engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(engine)
+        statements = []
+        event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        migrate_database(engine)
+
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith(("DELETE", "UPDATE", "SELECT id"))])
+
+
+class TestGridSnapping(unittest.TestCase):
+
+    def test_nearby_points_share_a_cell(self):
+        # Two venues a few hundred meters apart resolve to the same grid point
+        self.assertEqual(snap_to_grid(30.2672, -97.7431), (30.3, -97.7))
+        self.assertEqual(snap_to_grid(30.2672, -97.7431), snap_to_grid(30.2651, -97.7402))
+        self.assertEqual(snap_to_grid(30.2672, -97.7431, resolution=0.25), (30.25, -97.75))
+
+    def test_collector_keys_on_the_cell(self):
+        # The collector requests and stores the cell but remembers the original point
+        collector = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024, grid_resolution=0.1)
+        self.assertEqual((collector.latitude, collector.longitude), (30.3, -97.7))
+        self.assertEqual((collector.requested_latitude, collector.requested_longitude), (30.2672, -97.7431))
+
+
+class TestClimatology(unittest.TestCase):
+
+    def setUp(self):
+        # Two years of synthetic data; 2024 is a leap year
+        self.dates = np.arange(np.datetime64("2023-01-01"), np.datetime64("2025-01-01"))
+        years = self.dates.astype("datetime64[Y]").astype(int) + 1970
+        self.values = np.stack([years - 1900.0, years - 1950.0, years - 1925.0,
+                                np.full(len(self.dates), 0.1), years - 2000.0], axis=1)
+
+    def test_every_calendar_day_gets_one_row(self):
+        # 366 rows; February 29 only has the leap year behind it
+        rows = {(row['month'], row['day']): row for row in build_climatology(self.dates, self.values)}
+        self.assertEqual(len(rows), 366)
+        self.assertEqual(rows[(2, 29)]['years'], 1)
+        self.assertEqual(rows[(8, 16)]['years'], 2)
+
+    def test_day_stats_match_calculate_statistics(self):
+        # A calendar day's row matches the collector's statistics for the same values
+        rows = {(row['month'], row['day']): row for row in build_climatology(self.dates, self.values)}
+        collector = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024, years=2)
+        collector.add_days(self.values[np.isin(self.dates.astype(str), ["2023-08-16", "2024-08-16"])])
+        collector.calculate_statistics()
+
+        for column in STATISTIC_COLUMNS:
+            self.assertEqual(rows[(8, 16)][column], getattr(collector, column), column)
+
+    def test_stored_day_is_one_indexed_read(self):
+        engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        rows = build_climatology(self.dates, self.values)
+        for row in rows:
+            row.update(latitude=30.2672, longitude=-97.7431, first_year=2023, last_year=2024)
+        bulk_add_climatology(rows, session)
+
+        record = query_climatology(30.2672, -97.7431, 8, 16, session=session)
+        self.assertEqual(record.avg_temperature, 98.5)
+        for variable, column in CLIMATOLOGY_SKETCHES.items():
+            sketch = HistogramSketch.from_bytes(variable, getattr(record, column))
+            self.assertEqual(sketch.count, 2, column)
+        session.close()
+
+
+class TestRunningStats(unittest.TestCase):
+
+    def test_merged_shards_match_a_single_pass(self):
+        # Accumulators built on separate shards merge to the statistics of all values together
+        values = np.random.default_rng(7).normal(85.0, 6.0, size=1000)
+        left, right = RunningStats(), RunningStats()
+        for value in values[:300]:
+            left.update(value)
+        right.update_many(values[300:])
+        merged = left.merge(right)
+
+        self.assertEqual(merged.count, 1000)
+        self.assertAlmostEqual(merged.mean, values.mean(), places=10)
+        self.assertAlmostEqual(merged.variance, values.var(), places=8)
+        self.assertEqual((merged.minimum, merged.maximum), (values.min(), values.max()))
+        self.assertAlmostEqual(merged.total, values.sum(), places=8)
+
+    def test_stored_record_extends_by_one_year(self):
+        # A new year merges into the stored accumulators and rewrites the record's statistics
+        engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+
+        collector = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024, years=2)
+        collector.add_days([[100.0, 75.0, 87.0, 0.0, 10.0], [98.0, 73.0, 85.0, 0.2, 12.0]])
+        collector.calculate_statistics()
+        bulk_add_weather_records([collector], session)
+        save_running_stats(30.2672, -97.7431, 8, 16, 2024, collector.stats, session)
+
+        new_year = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2025, years=1)
+        new_year.add_days([[104.0, 77.0, 89.0, 0.4, 8.0]])
+        extend_weather_record(30.2672, -97.7431, 8, 16, 2024, new_year.stats, session)
+
+        record = session.query(WeatherRecord).one()
+        self.assertEqual(record.avg_temperature, 87.0)
+        self.assertEqual(record.max_temperature, 104.0)
+        self.assertEqual(record.sum_precipitation, 0.6)
+        self.assertEqual(record.min_wind_speed, 8.0)
+        self.assertEqual(record.lookback, 3)
+        session.close()
+
+
+class TestHistogramSketch(unittest.TestCase):
+
+    def test_quantiles_within_one_bin_of_exact(self):
+        # Sketched percentiles of many values stay within one bin width of the exact ones
+        values = np.random.default_rng(3).normal(85.0, 8.0, size=20000)
+        sketch = HistogramSketch.for_variable("temperature_2m_mean")
+        sketch.update_many(values)
+
+        for q in (0.1, 0.5, 0.9):
+            self.assertAlmostEqual(sketch.quantile(q), np.quantile(values, q), delta=sketch.width)
+
+    def test_merged_and_serialized_sketches_keep_counts(self):
+        # Shards merge by adding bins, survive a bytes round trip and answer threshold probabilities
+        wet, dry = HistogramSketch.for_variable("precipitation_sum"), HistogramSketch.for_variable("precipitation_sum")
+        wet.update_many([0.25, 0.5, 0.1])
+        dry.update_many([0.0, 0.0, 0.05, np.nan])
+
+        merged = HistogramSketch.from_bytes("precipitation_sum", wet.merge(dry).to_bytes())
+        self.assertEqual(merged.count, 6)
+        self.assertAlmostEqual(merged.fraction_above(0.1), 0.5)
+
+    def test_sketches_are_stored_with_running_stats(self):
+        engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+
+        collector = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024, years=2)
+        collector.add_days([[100.0, 75.0, 87.0, 0.0, 10.0], [98.0, 73.0, 85.0, 0.2, 12.0]])
+        save_running_stats(30.2672, -97.7431, 8, 16, 2024, collector.stats, session, collector.sketches)
+
+        _, sketches = load_running_stats(30.2672, -97.7431, 8, 16, 2024, session)
+        self.assertEqual(sketches["temperature_2m_mean"].count, 2)
+        self.assertAlmostEqual(sketches["precipitation_sum"].fraction_above(0.1), 0.5)
+        session.close()
+
+
+class TestSessionManagement(unittest.TestCase):
+
+    def test_import_does_not_connect(self):
+        # Importing the module leaves engine creation to the first use
+        result = subprocess.run(
+            [sys.executable, "-c", "import database; print(database._engine is None)"],
+            capture_output=True, text=True, check=True
+        )
+        self.assertEqual(result.stdout.strip(), "True")
+
+    def test_each_thread_gets_its_own_session(self):
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(database.Session()))
+        thread.start()
+        thread.join()
+
+        self.assertIs(database.Session(), database.Session())
+        self.assertIsNot(sessions[0], database.Session())
+
+    def test_first_use_configures_once_across_threads(self):
+        # Threads racing on the lazy engine wait for the first one instead of each migrating
+        def slow_configure():
+            time.sleep(0.05)
+            calls.append(1)
+            database._engine = engine
+
+        calls = []
+        engine = object()
+        with mock.patch.object(database, "_engine", None), \
+                mock.patch("database.configure", side_effect=slow_configure):
+            threads = [threading.Thread(target=database.get_engine) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+
+    def test_readers_proceed_during_an_open_write(self):
+        # With WAL, a reader sees the last committed data while a writer holds its transaction
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f"sqlite:///{directory}/weather.db")
+            event.listen(engine, 'connect', database.set_sqlite_pragmas)
+            Base.metadata.create_all(engine)
+
+            with engine.connect() as writer, engine.connect() as reader:
+                self.assertEqual(reader.exec_driver_sql("PRAGMA journal_mode").scalar(), "wal")
+                writer.exec_driver_sql("BEGIN IMMEDIATE")
+                writer.exec_driver_sql(
+                    "INSERT INTO weather_records (latitude, longitude, latitude_key, longitude_key, month, day, year) "
+                    "VALUES (30.2672, -97.7431, 302672, -977431, 8, 16, 2024)"
+                )
+                count = reader.exec_driver_sql("SELECT COUNT(*) FROM weather_records").scalar()
+                writer.rollback()
+            engine.dispose()
+
+        self.assertEqual(count, 0)
+
+
+class TestRangeQueries(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(cls.engine)
+        cls.session = sessionmaker(bind=cls.engine)()
+        rows = []
+        for latitude in (30.1, 30.2, 31.0):
+            for day in (1, 2, 3):
+                for year in (2023, 2024):
+                    rows.append(dict(
+                        latitude=latitude, longitude=-97.7, month=8, day=day, year=year,
+                        avg_temperature=80.0 + day + (year - 2023), min_temperature=70.0, max_temperature=94.0 + day,
+                        avg_wind_speed=10.0, min_wind_speed=5.0, max_wind_speed=12.0 + day,
+                        sum_precipitation=0.1 * day, min_precipitation=0.0, max_precipitation=0.05 * day
+                    ))
+        bulk_add_weather_records(rows, cls.session)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def test_month_comes_back_as_columns(self):
+        columns = query_month(30.1, -97.7, 8, session=self.session)
+        np.testing.assert_array_equal(columns['day'], [1, 1, 2, 2, 3, 3])
+        np.testing.assert_array_equal(columns['avg_temperature'], [81, 82, 82, 83, 83, 84])
+
+    def test_bounding_box_selects_locations_inside(self):
+        columns = query_bounding_box(30.0, -98.0, 30.5, -97.0, 8, 2, year=2024, session=self.session)
+        np.testing.assert_array_equal(columns['latitude'], [30.1, 30.2])
+
+    def test_aggregates_and_threshold_counts_computed_in_sqlite(self):
+        columns = aggregate_month(30.1, -97.7, 8, hot_threshold=96.0, rain_threshold=0.1, session=self.session)
+        np.testing.assert_array_equal(columns['avg_temperature'], [81.5, 82.5, 83.5])
+        np.testing.assert_array_equal(columns['hot_records'], [0, 2, 2])
+        np.testing.assert_array_equal(columns['rainy_records'], [0, 2, 2])
+
+        by_location = aggregate_bounding_box(30.0, -98.0, 32.0, -97.0, 8, 3, session=self.session)
+        np.testing.assert_array_equal(by_location['latitude'], [30.1, 30.2, 31.0])
+        np.testing.assert_array_equal(by_location['records'], [2, 2, 2])
+
+
+class TestBatchCollector(unittest.TestCase):
+
+    def test_results_stream_for_every_job(self):
+        # Every job yields exactly one result, in completion order
+        jobs = [(30.2672 + i, -97.7431, 8, 16, 2024) for i in range(5)]
+        with mock.patch("batch.WeatherDataCollector") as collector:
+            results = list(batch.collect_batch(jobs, max_workers=2, requests_per_second=0))
+
+        self.assertEqual(sorted(result.job for result in results), jobs)
+        self.assertEqual(collector.call_count, 5)
+        self.assertTrue(all(result.error is None for result in results))
+
+    def test_failed_job_is_retried_then_reported(self):
+        # A job that keeps failing is attempted retries + 1 times and reports its last error
+        with mock.patch("batch.WeatherDataCollector") as collector, mock.patch("batch.time.sleep"):
+            collector.return_value.fetch_historical_data.side_effect = ConnectionError("boom")
+            results = list(batch.collect_batch([(30.2672, -97.7431, 8, 16, 2024)],
+                                               requests_per_second=0, retries=2))
+
+        self.assertEqual(collector.call_count, 3)
+        self.assertIsNone(results[0].collector)
+        self.assertIsInstance(results[0].error, ConnectionError)
+
+    def test_limiters_are_shared_per_host_and_rate(self):
+        unlimited = batch.get_rate_limiter("archive.test", 0)
+        self.assertIs(batch.get_rate_limiter("archive.test", 0), unlimited)
+        limited = batch.get_rate_limiter("archive.test", 5.0)
+        self.assertIsNot(limited, unlimited)
+        self.assertEqual((unlimited.interval, limited.interval), (0.0, 0.2))
+
+    def test_every_archive_request_takes_a_slot(self):
+        # A job whose window has two archive gaps sends two requests, and waits for a slot for each
+        limiter = mock.Mock()
+        with StandInArchive() as server, tempfile.TemporaryDirectory() as directory:
+            archive = WeatherArchive(f"{directory}/archive")
+            archive.write(30.2672, -97.7431, "2023-01-01", np.ones((181, len(openmeteo.DAILY_VARIABLES))))
+            client = openmeteo_requests.Client(session=WeatherCacheSession(f"{directory}/cache"))
+            with mock.patch.object(openmeteo, "ARCHIVE_URL", server.url), \
+                    mock.patch.object(openmeteo, "openmeteo", client), \
+                    mock.patch("batch.get_rate_limiter", return_value=limiter):
+                results = list(batch.collect_batch([(30.2672, -97.7431, 8, 16, 2024, 3)], archive=archive))
+
+        self.assertIsNone(results[0].error)
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(limiter.acquire.call_count, 2)
+        self.assertIsNone(openmeteo.request_limiter.get())
+
+
+class TestMultiLocationFetch(unittest.TestCase):
+
+    @staticmethod
+    def fake_response(offset):
+        # Mimic the FlatBuffer accessors used by stack_daily_data: 3 days per variable
+        variables = [mock.Mock() for _ in openmeteo.DAILY_VARIABLES]
+        for j, variable in enumerate(variables):
+            variable.ValuesAsNumpy.return_value = np.arange(3, dtype=np.float32) + offset + 10 * j
+            variable.ValuesLength.return_value = 3
+        response = mock.Mock()
+        response.Daily.return_value.Variables.side_effect = lambda j: variables[j]
+        return response
+
+    def test_locations_are_packed_into_capped_requests(self):
+        def weather_api(url, params):
+            return [self.fake_response(0) for _ in params["latitude"].split(",")]
+
+        with mock.patch.object(openmeteo.openmeteo, "weather_api", side_effect=weather_api) as api:
+            responses = openmeteo.fetch_weather_data_batch(
+                [30.1, 30.2, 30.3, 30.4, 30.5], [-97.1, -97.2, -97.3, -97.4, -97.5],
+                "2024-08-14", "2024-08-16", max_locations=2
+            )
+
+        self.assertEqual(api.call_count, 3)
+        self.assertEqual(api.call_args_list[0].kwargs["params"]["latitude"], "30.1,30.2")
+        self.assertEqual(len(responses), 5)
+
+    def test_responses_stack_into_location_day_variable_array(self):
+        stacked = openmeteo.stack_daily_data([self.fake_response(0), self.fake_response(100)])
+
+        self.assertEqual(stacked.shape, (2, 3, len(openmeteo.DAILY_VARIABLES)))
+        self.assertEqual(stacked[1, 2, 4], 142.0)
+
+    def test_lean_decode_matches_dataframe_decode(self):
+        response = self.fake_response(0)
+        daily = response.Daily.return_value
+        daily.Time.return_value = 1723766400
+        daily.TimeEnd.return_value = 1723766400 + 3 * 86400
+        daily.Interval.return_value = 86400
+
+        series = openmeteo.decode_daily_data(response)
+        frame = openmeteo.process_daily_data(response)
+
+        self.assertEqual(series.interval, 86400)
+        np.testing.assert_array_equal(series.to_array(), frame[openmeteo.DAILY_VARIABLES].to_numpy())
+        self.assertEqual(len(frame["date"]), 3)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_identical_fetches_share_one_request(self):
+        # Callers arriving while a fetch is in flight wait for it instead of sending their own
+        release = threading.Event()
+        calls = []
+
+        def slow_fetch(*args):
+            calls.append(args)
+            release.wait(5)
+            return np.zeros((1, len(openmeteo.DAILY_VARIABLES)))
+
+        results = []
+        with mock.patch("openmeteo.fetch_and_decode_daily", side_effect=slow_fetch):
+            threads = [threading.Thread(target=lambda: results.append(
+                openmeteo.fetch_daily_values(30.2672, -97.7431, "2024-08-16", "2024-08-16"))) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            while not calls:
+                time.sleep(0.01)
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_errors_reach_every_waiter_and_are_not_kept(self):
+        flight = openmeteo.SingleFlight()
+        with self.assertRaises(ConnectionError):
+            flight.do("key", mock.Mock(side_effect=ConnectionError("boom")))
+        self.assertEqual(flight.do("key", lambda: 42), 42)
+
+
+class FakeArchiveAdapter(BaseAdapter):
+    """Answers every request with a fixed-size body and counts what reached the network."""
+
+    def __init__(self, size=1000):
+        super().__init__()
+        self.size = size
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b"x" * self.size
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class TestWeatherCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.adapter = FakeArchiveAdapter()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def new_session(self, policy):
+        cache = WeatherCacheSession(f"{self.directory.name}/cache", policy=policy)
+        cache.mount("https://", self.adapter)
+        return cache
+
+    def get(self, cache, end_date):
+        return cache.get(openmeteo.ARCHIVE_URL, params={"end_date": end_date})
+
+    def test_recent_dates_expire_sooner_than_old_dates(self):
+        policy = CachePolicy(recent_days=30, recent_ttl=timedelta(hours=6), old_ttl=-1)
+        today = date(2024, 8, 16)
+        self.assertEqual(expire_after_for(f"{openmeteo.ARCHIVE_URL}?end_date=2024-08-01", policy, today),
+                         timedelta(hours=6))
+        self.assertEqual(expire_after_for(f"{openmeteo.ARCHIVE_URL}?end_date=2020-08-16", policy, today), -1)
+        self.assertIsNone(expire_after_for(openmeteo.ARCHIVE_URL, policy, today))
+
+    def test_counts_hits_and_misses(self):
+        cache = self.new_session(CachePolicy())
+        self.get(cache, "2020-08-16")
+        self.get(cache, "2020-08-16")
+        stats = cache.cache_stats()
+        self.assertEqual(self.adapter.calls, 1)
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_evicts_least_recently_used_past_byte_budget(self):
+        cache = self.new_session(CachePolicy(max_bytes=5000, vacuum_every=2))
+        for day in range(1, 4):
+            self.get(cache, f"2020-08-{day:02d}")
+        # Touch the oldest entry so the second one becomes least recently used
+        self.get(cache, "2020-08-01")
+        for day in range(4, 9):
+            self.get(cache, f"2020-08-{day:02d}")
+
+        stats = cache.cache_stats()
+        self.assertLessEqual(stats["bytes"], 5000)
+        self.assertGreater(stats["evictions"], 0)
+        self.assertGreater(stats["vacuums"], 0)
+
+        calls = self.adapter.calls
+        self.get(cache, "2020-08-08")
+        self.assertEqual(self.adapter.calls, calls)
+        self.get(cache, "2020-08-02")
+        self.assertEqual(self.adapter.calls, calls + 1)
+
+    def test_budget_survives_reopening(self):
+        self.get(self.new_session(CachePolicy()), "2020-08-16")
+        reopened = self.new_session(CachePolicy())
+        self.assertGreater(reopened.cache_stats()["bytes"], 0)
+
+
+class TestStandInArchive(unittest.TestCase):
+
+    def test_serves_decodable_synthetic_responses(self):
+        with StandInArchive() as archive, tempfile.TemporaryDirectory() as directory:
+            client = openmeteo_requests.Client(session=WeatherCacheSession(f"{directory}/cache"))
+            params = openmeteo.archive_params("30.0,31.0", "-97.0,-97.0", "2024-08-14", "2024-08-16")
+            responses = client.weather_api(archive.url, params=params)
+
+        _, expected = synthetic_daily(31.0, "2024-08-14", "2024-08-16", openmeteo.DAILY_VARIABLES)
+        self.assertEqual(len(responses), 2)
+        np.testing.assert_array_equal(openmeteo.decode_daily_data(responses[1]).to_array(),
+                                      np.column_stack(expected))
+
+    def test_collector_benchmark_runs_offline(self):
+        archive_url = openmeteo.ARCHIVE_URL
+        with StandInArchive() as archive:
+            result = benchmark.bench_collector(4, archive.url, max_workers=1, repeat_fraction=0.5)
+
+        self.assertEqual(result['failed'], 0)
+        self.assertEqual(result['cache']['hits'], 2)
+        self.assertEqual(openmeteo.ARCHIVE_URL, archive_url)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_phases_and_counters_reach_snapshot_and_log_line(self):
+        metrics = Metrics()
+
+        @metrics.timed("decode")
+        def decode():
+            return 1
+
+        decode()
+        decode()
+        with metrics.phase("fetch"):
+            pass
+        metrics.increment("bytes_received", 2048)
+        metrics.increment("retries", 0)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["phases"]["decode"]["calls"], 2)
+        self.assertEqual(snapshot["counters"], {"bytes_received": 2048})
+        self.assertTrue(metrics.log_line().startswith("decode=2x/"))
+        self.assertIn("bytes_received=2048", metrics.log_line())
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {"phases": {}, "counters": {}})
+
+    def test_missing_data_is_logged_not_printed(self):
+        collector = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024, years=2)
+        values = np.full((367, len(openmeteo.DAILY_VARIABLES)), np.nan)
+        with mock.patch("WeatherDataCollector.fetch_daily_values", return_value=values), \
+                self.assertLogs("WeatherDataCollector", level="WARNING") as logs:
+            collector.fetch_historical_span()
+
+        self.assertEqual(len(logs.records), 2)
+
+
+class TestEventsBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.events = f"{self.directory.name}/events.csv"
+        with open(self.events, "w") as events:
+            events.write("lat,lon,date,lookback\n"
+                         "30.2672,-97.7431,2024-08-16,3\n"
+                         "29.7604,-95.3698,2024-08-16,\n"
+                         "30.2672,-97.7431,2024-08-16,5\n")
+        engine = create_engine(f"sqlite:///{self.directory.name}/weather.db")
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.archive = StandInArchive().start()
+        client = openmeteo_requests.Client(session=WeatherCacheSession(f"{self.directory.name}/cache"))
+        self.patches = [mock.patch.object(openmeteo, "ARCHIVE_URL", self.archive.url),
+                        mock.patch.object(openmeteo, "openmeteo", client)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.archive.stop()
+        self.session.close()
+        self.directory.cleanup()
+
+    def run_events(self):
+        return main.run_events(self.events, max_workers=2, requests_per_second=0, flush_every=1,
+                               session=self.session)
+
+    def write_events(self, *rows):
+        with open(self.events, "w") as events:
+            events.write("lat,lon,date,lookback\n" + "".join(f"{row}\n" for row in rows))
+
+    def test_events_file_is_collected_and_checkpointed(self):
+        # Row 2 asks for the record of row 0 with another lookback; it is reported, not collected
+        report = self.run_events()
+
+        self.assertEqual((report["collected"], report["skipped"], report["conflicts"], report["failed"]),
+                         (2, 0, 1, 0))
+        lookbacks = dict(self.session.query(WeatherRecord.latitude, WeatherRecord.lookback))
+        self.assertEqual(lookbacks, {30.2672: 3, 29.7604: 5})
+        self.assertEqual(main.load_checkpoint(f"{self.events}.checkpoint"), {
+            (302672, -977431, 8, 16, 2024, 3),
+            (297604, -953698, 8, 16, 2024, 5),
+        })
+
+        # A rerun finds everything done
+        report = self.run_events()
+        self.assertEqual((report["collected"], report["skipped"], report["conflicts"]), (0, 2, 1))
+        self.assertEqual(self.archive.requests, 2)
+
+    def test_resume_skips_checkpointed_events(self):
+        main.append_checkpoint(f"{self.events}.checkpoint", [(297604, -953698, 8, 16, 2024, 5)])
+        report = self.run_events()
+
+        self.assertEqual((report["collected"], report["skipped"]), (1, 1))
+        self.assertEqual(self.archive.requests, 1)
+
+    def test_checkpoint_survives_an_edited_file(self):
+        # Inserting a row shifts every row number; only the new event is collected
+        self.run_events()
+        self.write_events("32.7767,-96.7970,2024-08-16,3", "30.2672,-97.7431,2024-08-16,3",
+                          "29.7604,-95.3698,2024-08-16,")
+        report = self.run_events()
+
+        self.assertEqual((report["collected"], report["skipped"]), (1, 2))
+        self.assertEqual(self.archive.requests, 3)
+
+    def test_record_without_a_lookback_is_collected_again(self):
+        # A record written before lookbacks were stored may cover any window, so it is not trusted
+        bulk_add_weather_records([dict(latitude=29.7604, longitude=-95.3698, month=8, day=16, year=2024,
+                                       **{column: 90.0 for column in STATISTIC_COLUMNS})], self.session)
+        report = self.run_events()
+
+        self.assertEqual((report["collected"], report["skipped"]), (2, 0))
+        record = self.session.query(WeatherRecord).filter_by(latitude=29.7604).one()
+        self.assertEqual(record.lookback, 5)
+
+    def test_stored_record_with_another_lookback_is_collected_again(self):
+        self.run_events()
+        self.write_events("30.2672,-97.7431,2024-08-16,10")
+        report = self.run_events()
+
+        self.assertEqual((report["collected"], report["skipped"]), (1, 0))
+        record = self.session.query(WeatherRecord).filter_by(latitude=30.2672).one()
+        self.assertEqual(record.lookback, 10)
+
+    def test_jobs_use_their_own_lookback(self):
+        events = main.read_events(self.events, default_years=7)
+        self.assertEqual([job[5] for _, job in events], [3, 7, 5])
+
+
+class TestReadService(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = f"{self.directory.name}/weather.db"
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        rows = [dict(latitude=30.2672, longitude=-97.7431, month=8, day=16, year=year,
+                     **{column: 90.0 + year - 2020 for column in STATISTIC_COLUMNS}) for year in (2023, 2024)]
+        bulk_add_weather_records(rows, session)
+        session.close()
+        engine.dispose()
+
+        self.client = TestClient(TestServer(service.create_app(f"sqlite+aiosqlite:///{path}")))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.directory.cleanup()
+
+    async def test_single_lookup_with_etag(self):
+        query = {"lat": "30.2672", "lon": "-97.7431", "month": "8", "day": "16", "year": "2024"}
+        response = await self.client.get("/records", params=query)
+        self.assertEqual(response.status, 200)
+        self.assertEqual((await response.json())["avg_temperature"], 94.0)
+
+        etag = response.headers["ETag"]
+        response = await self.client.get("/records", params=query, headers={"If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(self.client.app[service.CACHE].hits, 1)
+
+        response = await self.client.get("/records", params=dict(query, year="2019"))
+        self.assertEqual(response.status, 404)
+
+    async def test_cached_keys_skip_the_database(self):
+        # Once every key of a request is cached, the request does not check out a connection
+        keys = [{"lat": 30.2672, "lon": -97.7431, "month": 8, "day": 16, "year": year} for year in (2024, 2019)]
+        await self.client.post("/records/batch", json={"keys": keys})
+
+        with mock.patch.object(type(self.client.app[service.ENGINE]), "connect",
+                               side_effect=AssertionError("connection checked out")):
+            response = await self.client.post("/records/batch", json={"keys": keys})
+        self.assertEqual(response.status, 200)
+        self.assertEqual([record and record["year"] for record in (await response.json())["records"]], [2024, None])
+
+    async def test_legacy_database_is_migrated_on_startup(self):
+        # A database from before the key columns existed is served once the service has started
+        path = f"{self.directory.name}/legacy.db"
+        engine = create_engine(f"sqlite:///{path}")
+        create_legacy_weather_table(engine)
+        engine.dispose()
+
+        async with TestClient(TestServer(service.create_app(f"sqlite+aiosqlite:///{path}"))) as client:
+            query = {"lat": "30.2672", "lon": "-97.7431", "month": "8", "day": "16", "year": "2024"}
+            response = await client.get("/records", params=query)
+            self.assertEqual(response.status, 200)
+            self.assertEqual((await response.json())["avg_temperature"], 88.0)
+
+            response = await client.get("/records", params=dict(query, year="2019"))
+            self.assertEqual(response.status, 404)
+
+    async def test_missing_database_answers_not_found(self):
+        path = f"{self.directory.name}/missing.db"
+        async with TestClient(TestServer(service.create_app(f"sqlite+aiosqlite:///{path}"))) as client:
+            response = await client.get("/records", params={"lat": "30.2672", "lon": "-97.7431", "month": "8",
+                                                           "day": "16", "year": "2024"})
+            self.assertEqual(response.status, 404)
+
+    async def test_batch_lookup_keeps_key_order(self):
+        keys = [{"lat": 30.2672, "lon": -97.7431, "month": 8, "day": 16, "year": year} for year in (2024, 2019, 2023)]
+        response = await self.client.post("/records/batch", json={"keys": keys})
+        records = (await response.json())["records"]
+
+        self.assertEqual([record and record["year"] for record in records], [2024, None, 2023])
+
+        response = await self.client.post("/records/batch", json={"keys": [{"lat": 30.2672}]})
+        self.assertEqual(response.status, 400)
+
+
+class TestHourlyAggregation(unittest.TestCase):
+
+    def test_bands_hours_and_rolling_max(self):
+        # Two days whose hourly value is the hour of day, the second shifted up by 100
+        values = np.concatenate([np.arange(24), np.arange(24) + 100]).astype(np.float32)
+        aggregates = aggregate_hourly(day_matrix(values), hours=(18,), rolling_hours=3)
+
+        np.testing.assert_array_equal(aggregates["evening"], [20.5, 120.5])
+        np.testing.assert_array_equal(aggregates["18h"], [18.0, 118.0])
+        np.testing.assert_array_equal(aggregates["rolling_max_3h"], [22.0, 122.0])
+
+    def test_selected_days_only(self):
+        values = np.repeat(np.arange(10, dtype=np.float32), 24)
+        self.assertEqual(day_matrix(values, [2, 7]).shape, (2, 24))
+        np.testing.assert_array_equal(day_matrix(values, [2, 7])[:, 0], [2.0, 7.0])
+
+    def test_collector_folds_hourly_aggregates_for_target_days(self):
+        with StandInArchive() as archive, tempfile.TemporaryDirectory() as directory:
+            client = openmeteo_requests.Client(session=WeatherCacheSession(f"{directory}/cache"))
+            with mock.patch.object(openmeteo, "ARCHIVE_URL", archive.url), \
+                    mock.patch.object(openmeteo, "openmeteo", client):
+                collector = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024, years=3,
+                                                 hourly=["temperature_2m"], hours=(18,))
+                collector.fetch_historical_data()
+                collector.calculate_statistics()
+
+        self.assertEqual(collector.hourly_stats["temperature_2m_18h"].count, 3)
+        # The synthetic day swings 10 degrees around its mean and peaks at 15:00, so 18:00 sits
+        # 10 * cos(45 degrees) above the daily mean
+        self.assertAlmostEqual(collector.hourly_statistics["temperature_2m_18h"]["avg"] -
+                               collector.avg_temperature, 7.07, delta=0.02)
+        # One request for the daily span, and one per target day for its 24 hours
+        self.assertEqual(archive.requests, 4)
+
+    def test_hourly_variables_are_requested_per_target_day(self):
+        with StandInArchive() as server, tempfile.TemporaryDirectory() as directory:
+            client = openmeteo_requests.Client(session=WeatherCacheSession(f"{directory}/cache"))
+            with mock.patch.object(openmeteo, "ARCHIVE_URL", server.url), \
+                    mock.patch.object(openmeteo, "openmeteo", client), \
+                    mock.patch.object(client, "weather_api", wraps=client.weather_api) as weather_api:
+                collector = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024, years=3,
+                                                 archive=WeatherArchive(f"{directory}/archive"),
+                                                 hourly=["temperature_2m"], hours=(18,))
+                collector.fetch_historical_data()
+
+        daily, *hourly = (call.kwargs["params"] for call in weather_api.call_args_list)
+        self.assertNotIn("hourly", daily)
+        self.assertEqual([(params["start_date"], params["end_date"]) for params in hourly],
+                         [("2024-08-16", "2024-08-16"), ("2023-08-16", "2023-08-16"), ("2022-08-16", "2022-08-16")])
+        self.assertTrue(all(params.get("daily") is None and params["hourly"] == ["temperature_2m"]
+                            for params in hourly))
+        self.assertEqual(collector.hourly_stats["temperature_2m_18h"].count, 3)
+
+
+class TestWeatherArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.archive = WeatherArchive(self.tempdir.name)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_unknown_location_is_entirely_missing(self):
+        # A location that was never written reports the whole window as missing
+        ranges = self.archive.missing_ranges(30.2672, -97.7431, "2024-08-01", "2024-08-31")
+        self.assertEqual(ranges, [(np.datetime64("2024-08-01"), np.datetime64("2024-08-31"))])
+
+    def test_window_read_back_and_gaps_reported(self):
+        # Written days read back exactly; only the days around them are still missing
+        values = np.arange(10 * len(openmeteo.DAILY_VARIABLES), dtype=np.float32).reshape(10, -1)
+        self.archive.write(30.2672, -97.7431, "2024-08-10", values)
+
+        window = self.archive.read(30.2672, -97.7431, "2024-08-08", "2024-08-21")
+        np.testing.assert_array_equal(window[2:12], values)
+        self.assertTrue(np.isnan(window[:2]).all())
+
+        ranges = self.archive.missing_ranges(30.2672, -97.7431, "2024-08-08", "2024-08-21")
+        self.assertEqual(ranges, [
+            (np.datetime64("2024-08-08"), np.datetime64("2024-08-09")),
+            (np.datetime64("2024-08-20"), np.datetime64("2024-08-21")),
+        ])
+
+    def test_days_returned_empty_are_fetched_again(self):
+        # The archive answers the most recent days with nulls; those days stay missing until they hold data
+        values = np.ones((5, len(openmeteo.DAILY_VARIABLES)), dtype=np.float32)
+        collector = WeatherDataCollector(30.2672, -97.7431, 8, 16, 2024, years=1, archive=self.archive)
+        values[3:] = np.nan
+        with mock.patch("WeatherDataCollector.fetch_daily_values", return_value=values.copy()):
+            collector.daily_values("2024-08-12", "2024-08-16")
+        self.assertEqual(self.archive.missing_ranges(30.2672, -97.7431, "2024-08-12", "2024-08-16"),
+                         [(np.datetime64("2024-08-15"), np.datetime64("2024-08-16"))])
+
+        refetched = np.full((2, len(openmeteo.DAILY_VARIABLES)), 2.0, dtype=np.float32)
+        with mock.patch("WeatherDataCollector.fetch_daily_values", return_value=refetched) as fetch:
+            window = collector.daily_values("2024-08-12", "2024-08-16")
+        fetch.assert_called_once_with(30.2672, -97.7431, np.datetime64("2024-08-15"), np.datetime64("2024-08-16"))
+        np.testing.assert_array_equal(window[3:], refetched)
+        self.assertEqual(self.archive.missing_ranges(30.2672, -97.7431, "2024-08-12", "2024-08-16"), [])
+
+    def test_only_written_years_take_space(self):
+        # A window spanning a new year creates one file per year it has data for, and nothing else
+        values = np.ones((4, len(openmeteo.DAILY_VARIABLES)), dtype=np.float32)
+        self.archive.write(30.2672, -97.7431, "2023-12-30", values)
+
+        cell = f"{self.tempdir.name}/{self.archive.cell_name(30.2672, -97.7431)}"
+        self.assertEqual(sorted(os.listdir(cell)), ["2023.npy", "2024.npy"])
+        np.testing.assert_array_equal(self.archive.read(30.2672, -97.7431, "2023-12-30", "2024-01-02"), values)
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc to count open files")
+    def test_open_year_files_are_bounded(self):
+        # Writing more cells than the bound keeps only the most recent maps, and their descriptors, open
+        archive = WeatherArchive(self.tempdir.name, max_open_chunks=8)
+        values = np.ones((2, len(openmeteo.DAILY_VARIABLES)), dtype=np.float32)
+        open_files = len(os.listdir("/proc/self/fd"))
+        for cell in range(40):
+            archive.write(30.0 + cell / 100, -97.0, "2023-12-31", values)
+
+        self.assertEqual(len(archive._chunks), 8)
+        self.assertLessEqual(len(os.listdir("/proc/self/fd")) - open_files, 8)
+        for cell in range(40):
+            np.testing.assert_array_equal(archive.read(30.0 + cell / 100, -97.0, "2023-12-31", "2024-01-01"), values)
+
+    def test_interrupted_create_leaves_no_unreadable_file(self):
+        # A crash mid-create only leaves a temporary file; the year still reads as missing and is written later
+        cell = f"{self.tempdir.name}/{self.archive.cell_name(30.2672, -97.7431)}"
+        os.makedirs(cell)
+        with open(f"{cell}/2024.npy.1234.tmp", "wb") as f:
+            f.write(b"\x93NUMPY")
+
+        self.assertEqual(len(self.archive.missing_ranges(30.2672, -97.7431, "2024-08-01", "2024-08-02")), 1)
+        self.archive.write(30.2672, -97.7431, "2024-08-01", np.ones((2, len(openmeteo.DAILY_VARIABLES))))
+        self.assertEqual(self.archive.missing_ranges(30.2672, -97.7431, "2024-08-01", "2024-08-02"), [])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,13 @@
+import argparse
 import psycopg2
 from psycopg2 import OperationalError, ProgrammingError
 from sql_queries import create_table_queries, drop_table_queries
 
 
-def create_database():
+def create_database(drop=True):
     """
     Creates and connects to the sparkifydb.
+    With drop=False an existing sparkifydb is kept, and only created when it is missing.
     Returns the connection and cursor to sparkifydb.
     Handles potential errors in database creation.
     """
@@ -18,8 +20,11 @@ def create_database():
         cur = conn.cursor()
 
         # Create sparkify database with UTF8 encoding
-        cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-        cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+        if drop:
+            cur.execute("DROP DATABASE IF EXISTS sparkifydb")
+        cur.execute("SELECT 1 FROM pg_database WHERE datname = 'sparkifydb'")
+        if cur.fetchone() is None:
+            cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
 
         # Close connection to the default database
         conn.close()
@@ -74,14 +79,21 @@ def create_tables(cur, conn):
 def main():
     """
     Main function to manage the database creation, table dropping, and table creation process.
+    With --keep, existing data is kept and only missing tables are created, for incremental loads.
     Includes error handling and proper closing of connections.
     """
+    parser = argparse.ArgumentParser(description='Create the sparkifydb schema.')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the existing database and tables, creating only what is missing')
+    args = parser.parse_args()
+
     conn = None
     cur = None
     try:
-        cur, conn = create_database()
+        cur, conn = create_database(drop=not args.keep)
 
-        drop_tables(cur, conn)
+        if not args.keep:
+            drop_tables(cur, conn)
         create_tables(cur, conn)
 
     except Exception as e:
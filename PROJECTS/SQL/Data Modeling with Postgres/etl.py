@@ -1,32 +1,125 @@
+import argparse
+import io
 import os
 import glob
+import hashlib
+import queue
+import threading
 import psycopg2
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from itertools import islice
 import pandas as pd
 import numpy as np
 from sql_queries import *
 
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
 
-def process_song_file(cur, filepath):
+# Files bulk loaded per COPY and transaction. Song files hold a single record each.
+SONG_BATCH_SIZE = 1000
+LOG_BATCH_SIZE = 1
+
+# Song durations are matched after rounding to the scale they are recorded at in the song files
+DURATION_DECIMALS = 5
+
+
+def copy_rows(cur, df, table, columns, merge):
     """
-    Process song file and insert song and artist records into database.
+    Bulk load a DataFrame into a table.
+    - Writes the rows as CSV into an in-memory buffer.
+    - Streams the buffer with COPY into the table's staging table.
+    - Merges the staging table into the table with its conflict handling.
+    """
+    if df.empty:
+        return
+
+    buffer = io.StringIO()
+    df.to_csv(buffer, header=False, index=False, na_rep='\\N')
+    buffer.seek(0)
+
+    cur.copy_expert(staging_copy.format(table=table, columns=', '.join(columns)), buffer)
+    cur.execute(merge)
+
+
+def transform_song_file(filepath):
+    """
+    Read a song file into its song and artist records.
+    Returns a dict of DataFrames keyed by table, in load order.
     """
-    # open song file
     df = pd.read_json(filepath, lines=True)
 
-    # insert song record
-    song_data = (df.song_id.values[0], df.title.values[0], df.artist_id.values[0], int(df.year.values[0]), float(df.duration.values[0]))
-    cur.execute(song_table_insert, song_data)
-    
-    # insert artist record
-    artist_data = (df.artist_id.values[0], df.artist_name.values[0], df.artist_location.values[0], 
-                   float(df.artist_latitude.values[0]) if pd.notnull(df.artist_latitude.values[0]) else None, 
-                   float(df.artist_longitude.values[0]) if pd.notnull(df.artist_longitude.values[0]) else None)
-    cur.execute(artist_table_insert, artist_data)
+    return {
+        'songs': df[['song_id', 'title', 'artist_id', 'year', 'duration']],
+        'artists': df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']]
+    }
 
 
-def process_log_file(cur, filepath):
+def load_song_lookup(cur):
     """
-    Process log file and insert time, user, and songplay records into database.
+    Read every song with its artist into a lookup table keyed on title, artist name and
+    duration, the columns song_select matches on. Returns a DataFrame with one row per key.
+    """
+    cur.execute(song_lookup_select)
+    lookup = pd.DataFrame(cur.fetchall(), columns=['song', 'artist', 'duration', 'song_id', 'artist_id'])
+    lookup['duration'] = lookup['duration'].astype(float).round(DURATION_DECIMALS)
+    # song_select never matches a NULL duration, while a merge would pair NaN with NaN
+    return lookup.dropna(subset=['duration']).drop_duplicates(['song', 'artist', 'duration'])
+
+
+def lookup_song_ids(df, song_lookup):
+    """
+    Resolve song_id and artist_id for every log event with a left merge on the song lookup.
+    Returns a DataFrame aligned with df, with NaN where no song matches.
+    """
+    events = pd.DataFrame({
+        'song': df['song'].values,
+        'artist': df['artist'].values,
+        'duration': df['length'].astype(float).round(DURATION_DECIMALS).values
+    })
+    matches = events.merge(song_lookup, how='left', on=['song', 'artist', 'duration'])
+    return matches[['song_id', 'artist_id']]
+
+
+def time_records(t):
+    """
+    Break timestamps down into time table records, one per distinct timestamp.
+    Week is the ISO week and weekday counts from Monday as 0, as Timestamp.week and weekday() do.
+    """
+    t = pd.Series(t).drop_duplicates()
+
+    return pd.DataFrame({
+        'start_time': t.values,
+        'hour': t.dt.hour.values,
+        'day': t.dt.day.values,
+        'week': t.dt.isocalendar().week.astype('int64').values,
+        'month': t.dt.month.values,
+        'year': t.dt.year.values,
+        'weekday': t.dt.weekday.values
+    })
+
+
+def drop_loaded_times(time_df, loaded_times):
+    """
+    Drop time records whose start_time is in loaded_times, a set of timestamps (int64 nanoseconds)
+    already loaded in this run.
+    """
+    keys = time_df['start_time'].values.astype('int64').tolist()
+    return time_df[~np.fromiter(map(loaded_times.__contains__, keys), bool, len(keys))]
+
+
+def mark_loaded_times(time_df, loaded_times):
+    """
+    Add the start_time of loaded time records to loaded_times.
+    """
+    loaded_times.update(time_df['start_time'].values.astype('int64').tolist())
+
+
+def transform_log_file(filepath, song_lookup):
+    """
+    Read a log file into its time, user, and songplay records, resolving songs against song_lookup.
+    Returns a dict of DataFrames keyed by table, in load order.
     """
     # open log file
     df = pd.read_json(filepath, lines=True)
@@ -36,72 +129,427 @@ def process_log_file(cur, filepath):
 
     # convert timestamp column to datetime
     t = pd.to_datetime(df['ts'], unit='ms')
-    
-    # insert time data records
-    time_data = [(time, time.hour, time.day, time.week, time.month, time.year, time.weekday()) for time in t]
-    column_labels = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
-    time_df = pd.DataFrame(time_data, columns=column_labels)
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+    # time data records
+    time_df = time_records(t)
 
-    # load user table
+    # user records, deduplicated per file as the row-by-row load did, so the last level wins
     user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']].drop_duplicates()
 
-    # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
-
-    # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
+    # get songid and artistid from the song lookup
+    song_ids = lookup_song_ids(df, song_lookup)
+
+    # songplay records
+    songplay_df = pd.DataFrame({
+        'start_time': t.values,
+        'user_id': df['userId'].values,
+        'level': df['level'].values,
+        'song_id': song_ids['song_id'].values,
+        'artist_id': song_ids['artist_id'].values,
+        'session_id': df['sessionId'].values,
+        'location': df['location'].values,
+        'user_agent': df['userAgent'].values
+    })
+
+    return {'time': time_df, 'users': user_df, 'songplays': songplay_df}
 
-        # insert songplay record
-        songplay_data = (pd.to_datetime(row.ts, unit='ms'), row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
 
+# Staging table, COPY columns and merge statement of each table
+TABLE_LOADS = {
+    'songs': ('songs_staging', song_staging_columns, song_table_merge),
+    'artists': ('artists_staging', artist_staging_columns, artist_table_merge),
+    'time': ('time_staging', time_staging_columns, time_table_merge),
+    'users': ('users_staging', user_staging_columns, user_table_merge),
+    'songplays': ('songplays_staging', songplay_staging_columns, songplay_table_merge)
+}
 
-def process_data(cur, conn, filepath, func):
+# Incremental loads skip songplays that are already loaded, as a changed log file is read again in full
+INCREMENTAL_TABLE_LOADS = dict(TABLE_LOADS, songplays=('songplays_staging', songplay_staging_columns,
+                                                       songplay_table_merge_incremental))
+
+
+def load_records(cur, records, table_loads=TABLE_LOADS):
     """
-    Process all files in given directory and apply function to each file.
+    Bulk load the records of a batch of files, one COPY and merge per table.
+    `records` holds one dict of DataFrames per file, as returned by the transform functions.
+    """
+    if not records:
+        return
+
+    for query in staging_table_queries:
+        cur.execute(query)
+
+    for table in records[0]:
+        copy_rows(cur, pd.concat([record[table] for record in records]), *table_loads[table])
+
+
+def process_song_files(cur, filepaths):
+    """
+    Process a batch of song files and bulk load their song and artist records into database.
+    """
+    load_records(cur, [transform_song_file(filepath) for filepath in filepaths])
+
+
+def process_song_file(cur, filepath):
+    """
+    Process song file and insert song and artist records into database.
+    """
+    process_song_files(cur, [filepath])
+
+
+def process_log_files(cur, filepaths, song_lookup=None, loaded_times=None, table_loads=TABLE_LOADS):
+    """
+    Process a batch of log files and bulk load their time, user, and songplay records into database.
+    Songs are resolved against song_lookup, which is read from the database when not given.
+    Time records already in the loaded_times set are skipped, and the set is updated.
+    """
+    if song_lookup is None:
+        song_lookup = load_song_lookup(cur)
+
+    records = [transform_log_file(filepath, song_lookup) for filepath in filepaths]
+    if loaded_times is not None:
+        for record in records:
+            record['time'] = drop_loaded_times(record['time'], loaded_times)
+            mark_loaded_times(record['time'], loaded_times)
+
+    load_records(cur, records, table_loads)
+
+
+def process_log_file(cur, filepath):
+    """
+    Process log file and insert time, user, and songplay records into database.
+    """
+    process_log_files(cur, [filepath])
+
+
+def get_files(filepath):
+    """
+    Return the absolute paths of all JSON files under a directory.
     """
-    # get all files matching extension from directory
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root, '*.json'))
         for f in files:
             all_files.append(os.path.abspath(f))
 
+    return all_files
+
+
+def file_hash(filepath):
+    """
+    Return the SHA-256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_entry(filepath, hashed=True):
+    """
+    Return the (size, mtime, hash) manifest entry of a file. Unless hashed, the file is not
+    read and the hash is None.
+    """
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime, file_hash(filepath) if hashed else None
+
+
+def prune_manifest(cur, filepath, all_files):
+    """
+    Delete the manifest entries of files under a directory that are no longer there.
+    Returns the number of entries deleted.
+    """
+    root = os.path.join(os.path.abspath(filepath), '')
+    present = set(all_files)
+    cur.execute(manifest_select)
+    removed = [(path,) for path, size, mtime, digest in cur.fetchall()
+               if path.startswith(root) and path not in present]
+    cur.executemany(manifest_delete, removed)
+    return len(removed)
+
+
+def select_changed_files(cur, all_files):
+    """
+    Compare files against the file manifest and keep those that are new or changed.
+    - A file whose size and mtime match its manifest entry is unchanged and is not read.
+    - Otherwise its content hash decides; a file that was only touched gets its entry refreshed.
+      An entry recorded by a full run has no hash, so its file is loaded again once it changes at all.
+    Returns the files to load and a dict of their (size, mtime, hash) manifest entries.
+    """
+    cur.execute(manifest_select)
+    manifest = {path: (size, mtime, digest) for path, size, mtime, digest in cur.fetchall()}
+
+    changed_files = []
+    entries = {}
+    for f in all_files:
+        stat = os.stat(f)
+        loaded = manifest.get(f)
+        if loaded and loaded[:2] == (stat.st_size, stat.st_mtime):
+            continue
+
+        entry = (stat.st_size, stat.st_mtime, file_hash(f))
+        if loaded and loaded[2] == entry[2]:
+            cur.execute(manifest_upsert, (f, *entry))
+            continue
+
+        changed_files.append(f)
+        entries[f] = entry
+
+    return changed_files, entries
+
+
+def record_files(cur, filepaths, manifest):
+    """
+    Write the manifest entries of loaded files, in the transaction that loads them.
+    """
+    cur.executemany(manifest_upsert, [(f, *manifest[f]) for f in filepaths])
+
+
+def process_data(cur, conn, filepath, func, batch_size=None, incremental=False):
+    """
+    Process all files in given directory and apply function to each file, as func(cur, filepath).
+    With a batch_size, func is applied to lists of up to batch_size files instead, as
+    process_song_files and process_log_files expect.
+    Each file or batch is loaded and committed as one transaction, and records its files in the file
+    manifest before it commits. Manifest entries of files that are gone are deleted first.
+    When incremental, only files that are new or changed since the file manifest are processed.
+    Otherwise the manifest records only size and mtime, so the files are not read an extra time.
+    """
+    # get all files matching extension from directory
+    all_files = get_files(filepath)
+    prune_manifest(cur, filepath, all_files)
+
+    # keep the files that are not loaded yet
+    if incremental:
+        total_files = len(all_files)
+        all_files, manifest = select_changed_files(cur, all_files)
+        print(f'{total_files - len(all_files)} unchanged files skipped in {filepath}')
+    else:
+        manifest = {f: file_entry(f, hashed=False) for f in all_files}
+    conn.commit()
+
     # get total number of files found
     num_files = len(all_files)
     print(f'{num_files} files found in {filepath}')
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    # iterate over files, or batches of files, and process
+    step = batch_size or 1
+    for i in range(0, num_files, step):
+        batch = all_files[i:i + step]
+        func(cur, batch if batch_size else batch[0])
+        record_files(cur, batch, manifest)
+        conn.commit()
+        print(f'{min(i + step, num_files)}/{num_files} files processed.')
+
+
+# Transform function of the current worker process, set by init_worker
+worker_transform = None
+
+
+def init_worker(transform):
+    global worker_transform
+    worker_transform = transform
+
+
+def run_transform(filepath):
+    return worker_transform(filepath)
+
+
+def load_files(cur, conn, batch, manifest=None, table_loads=TABLE_LOADS):
+    """
+    Load and commit a batch of (filepath, records) pairs. When the batch fails it is rolled back
+    and its files are retried one at a time, so one bad file does not hold back the others.
+    With a manifest, the files' entries are recorded in the same transaction.
+    Returns the files that could not be loaded.
+    """
+    try:
+        load_records(cur, [records for filepath, records in batch], table_loads)
+        if manifest is not None:
+            record_files(cur, [filepath for filepath, records in batch], manifest)
         conn.commit()
-        print(f'{i}/{num_files} files processed.')
+        return []
+    except Exception as e:
+        conn.rollback()
+        if len(batch) == 1:
+            print(f'Error loading {batch[0][0]}: {e}')
+            return [batch[0][0]]
+
+    failed = []
+    for item in batch:
+        failed += load_files(cur, conn, [item], manifest, table_loads)
+    return failed
+
+
+def process_data_parallel(dsn, filepath, transform, workers, loaders=2, batch_size=1, deferred=(),
+                          loaded_times=None, incremental=False, table_loads=TABLE_LOADS):
+    """
+    Process all files in given directory with a pool of worker processes.
+    - Workers read and transform the files; their results are collected in file order.
+    - Up to `loaders` threads, each with its own connection, bulk load and commit batches of results.
+    - Tables in `deferred` are held back and loaded last, in file order and one transaction, so their
+      conflict handling sees the files in the same order as a sequential run.
+    - A file that fails to transform or load is reported and skipped, and every other file still loads.
+      A loader whose connection fails reports the files of each batch it takes as failed.
+    - If the worker pool breaks, the files it can no longer take are reported as failed too. However
+      the run ends, the loader threads are stopped and every connection is closed.
+    - With a loaded_times set, time records loaded earlier in the run are skipped before they are
+      queued; a timestamp is only marked loaded once its file has committed.
+    - A file's manifest entry is recorded with its last transaction, the deferred tables' one when
+      there are any. Manifest entries of files that are gone are deleted first.
+    - When incremental, only new or changed files are processed. Otherwise the manifest records only
+      size and mtime, so the files are not read an extra time.
+    Returns the list of files that failed.
+    """
+    failed = []
+    held = []
+    progress = {'processed': 0}
+    lock = threading.Lock()
+    batches = queue.Queue(maxsize=2 * loaders)
+    connections = []
+    threads = []
+
+    def loader(conn):
+        cur = conn.cursor()
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            try:
+                batch_failed = load_files(cur, conn, batch, None if deferred else manifest, table_loads)
+            except Exception as e:
+                # the connection itself failed, e.g. on rollback; keep draining so the producer never blocks
+                print(f'Error loading {len(batch)} files: {e}')
+                batch_failed = [datafile for datafile, records in batch]
+            with lock:
+                failed.extend(batch_failed)
+                if loaded_times is not None:
+                    for datafile, records in batch:
+                        if datafile not in batch_failed:
+                            mark_loaded_times(records['time'], loaded_times)
+                progress['processed'] += len(batch)
+                print(f"{progress['processed']}/{num_files} files processed.")
+
+    try:
+        for _ in range(loaders):
+            connections.append(psycopg2.connect(dsn))
+
+        all_files = get_files(filepath)
+        cur = connections[0].cursor()
+        prune_manifest(cur, filepath, all_files)
+        if incremental:
+            total_files = len(all_files)
+            all_files, manifest = select_changed_files(cur, all_files)
+            print(f'{total_files - len(all_files)} unchanged files skipped in {filepath}')
+        else:
+            manifest = {f: file_entry(f, hashed=False) for f in all_files}
+        connections[0].commit()
+
+        num_files = len(all_files)
+        print(f'{num_files} files found in {filepath}')
+
+        threads = [threading.Thread(target=loader, args=(conn,)) for conn in connections]
+        for thread in threads:
+            thread.start()
+
+        try:
+            with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(transform,)) as pool:
+                def submit(f):
+                    # a broken pool refuses new work; report its files like transform errors so the run ends
+                    try:
+                        return pool.submit(run_transform, f)
+                    except BrokenProcessPool as e:
+                        future = Future()
+                        future.set_exception(e)
+                        return future
+
+                # keep a bounded window of files in flight and take results in file order
+                files = iter(all_files)
+                pending = deque((f, submit(f)) for f in islice(files, 4 * workers))
+                batch = []
+                while pending:
+                    datafile, future = pending.popleft()
+                    for f in islice(files, 1):
+                        pending.append((f, submit(f)))
+
+                    try:
+                        records = future.result()
+                    except Exception as e:
+                        print(f'Error processing {datafile}: {e}')
+                        with lock:
+                            failed.append(datafile)
+                        continue
+
+                    if loaded_times is not None:
+                        with lock:
+                            records['time'] = drop_loaded_times(records['time'], loaded_times)
+                    held.append((datafile, {table: records.pop(table) for table in deferred}))
+                    batch.append((datafile, records))
+                    if len(batch) == batch_size:
+                        batches.put(batch)
+                        batch = []
+                if batch:
+                    batches.put(batch)
+        finally:
+            for thread in threads:
+                batches.put(None)
+            for thread in threads:
+                thread.join()
+
+        # load the held back tables of every file that loaded, in file order
+        if deferred:
+            conn = connections[0]
+            skipped = set(failed)
+            held = [item for item in held if item[0] not in skipped]
+            failed += load_files(conn.cursor(), conn, held, manifest, table_loads)
+    finally:
+        for conn in connections:
+            conn.close()
+
+    return failed
 
 
 def main():
     """
     - Establishes connection to database.
-    - Processes all song data files and log data files.
+    - Processes all song data files and log data files, in parallel when --workers is above 1.
+    - With --incremental, processes only files that are new or changed since the last run.
     - Closes database connection.
     """
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    parser = argparse.ArgumentParser(description='Load the Sparkify song and log data into sparkifydb.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes that read and transform files (1 processes them in this process)')
+    parser.add_argument('--loaders', type=int, default=2, help='database connections loading in parallel')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip files the file manifest records as loaded and unchanged')
+    args = parser.parse_args()
+    table_loads = INCREMENTAL_TABLE_LOADS if args.incremental else TABLE_LOADS
+
+    conn = psycopg2.connect(DSN)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    if args.workers > 1:
+        # songs and artists are fully loaded before the song lookup for the logs is read
+        failed = process_data_parallel(DSN, 'data/song_data', transform_song_file, args.workers,
+                                       args.loaders, SONG_BATCH_SIZE, incremental=args.incremental)
+        song_lookup = load_song_lookup(cur)
+        failed += process_data_parallel(DSN, 'data/log_data', partial(transform_log_file, song_lookup=song_lookup),
+                                        args.workers, args.loaders, LOG_BATCH_SIZE, deferred=('users',),
+                                        loaded_times=set(), incremental=args.incremental,
+                                        table_loads=table_loads)
+        if failed:
+            print(f'{len(failed)} files failed to load:')
+            for f in failed:
+                print(f'  {f}')
+    else:
+        process_data(cur, conn, filepath='data/song_data', func=process_song_files, batch_size=SONG_BATCH_SIZE,
+                     incremental=args.incremental)
+
+        song_lookup = load_song_lookup(cur)
+        process_data(cur, conn, filepath='data/log_data',
+                     func=partial(process_log_files, song_lookup=song_lookup, loaded_times=set(),
+                                  table_loads=table_loads),
+                     batch_size=LOG_BATCH_SIZE, incremental=args.incremental)
 
     conn.close()
 
@@ -5,6 +5,7 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS file_manifest"
 
 # CREATE TABLES
 
@@ -64,6 +65,20 @@ CREATE TABLE IF NOT EXISTS time (
 )
 """)
 
+songplay_event_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplays_event_idx ON songplays (start_time, user_id, session_id)
+""")
+
+manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS file_manifest (
+    path VARCHAR PRIMARY KEY,
+    size BIGINT NOT NULL,
+    mtime DOUBLE PRECISION NOT NULL,
+    hash VARCHAR(64),
+    loaded_at TIMESTAMP NOT NULL DEFAULT now()
+)
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
@@ -101,6 +116,149 @@ INSERT INTO time (
 ON CONFLICT DO NOTHING
 """)
 
+# STAGING TABLES
+# Bulk loads COPY each batch into a session-local staging table and merge it into the target
+# with the same conflict handling as the single-row inserts. ord keeps the input order, so the
+# merge keeps the same row a row-by-row load would: the first one, or the last for user levels.
+
+songplay_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplays_staging (
+    ord BIGSERIAL,
+    start_time TIMESTAMP,
+    user_id INT,
+    level VARCHAR,
+    song_id VARCHAR,
+    artist_id VARCHAR,
+    session_id INT,
+    location VARCHAR,
+    user_agent TEXT
+) ON COMMIT DELETE ROWS
+""")
+
+user_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS users_staging (
+    ord BIGSERIAL,
+    user_id INT,
+    first_name VARCHAR,
+    last_name VARCHAR,
+    gender VARCHAR(1),
+    level VARCHAR
+) ON COMMIT DELETE ROWS
+""")
+
+song_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songs_staging (
+    ord BIGSERIAL,
+    song_id VARCHAR,
+    title VARCHAR,
+    artist_id VARCHAR,
+    year INT,
+    duration NUMERIC
+) ON COMMIT DELETE ROWS
+""")
+
+artist_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS artists_staging (
+    ord BIGSERIAL,
+    artist_id VARCHAR,
+    name VARCHAR,
+    location VARCHAR,
+    latitude NUMERIC,
+    longitude NUMERIC
+) ON COMMIT DELETE ROWS
+""")
+
+time_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS time_staging (
+    ord BIGSERIAL,
+    start_time TIMESTAMP,
+    hour INT,
+    day INT,
+    week INT,
+    month INT,
+    year INT,
+    weekday INT
+) ON COMMIT DELETE ROWS
+""")
+
+# COPY RECORDS
+# NULL is spelled \N so that empty strings survive the CSV round trip as empty strings
+
+staging_copy = "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+songplay_staging_columns = ['start_time', 'user_id', 'level', 'song_id', 'artist_id', 'session_id', 'location', 'user_agent']
+user_staging_columns = ['user_id', 'first_name', 'last_name', 'gender', 'level']
+song_staging_columns = ['song_id', 'title', 'artist_id', 'year', 'duration']
+artist_staging_columns = ['artist_id', 'name', 'location', 'latitude', 'longitude']
+time_staging_columns = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+
+# MERGE STAGED RECORDS
+
+songplay_table_merge = ("""
+INSERT INTO songplays (
+    start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+)
+SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM songplays_staging
+ORDER BY ord
+ON CONFLICT DO NOTHING
+""")
+
+user_table_merge = ("""
+INSERT INTO users (
+    user_id, first_name, last_name, gender, level
+)
+SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender, level
+FROM users_staging
+ORDER BY user_id, ord DESC
+ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level
+""")
+
+# Incremental loads may re-read a changed log file, so events already in songplays are skipped
+songplay_table_merge_incremental = ("""
+INSERT INTO songplays (
+    start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+)
+SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM songplays_staging s
+WHERE NOT EXISTS (
+    SELECT 1 FROM songplays p
+    WHERE p.start_time = s.start_time AND p.user_id = s.user_id AND p.session_id = s.session_id
+)
+ORDER BY ord
+ON CONFLICT DO NOTHING
+""")
+
+song_table_merge = ("""
+INSERT INTO songs (
+    song_id, title, artist_id, year, duration
+)
+SELECT DISTINCT ON (song_id) song_id, title, artist_id, year, duration
+FROM songs_staging
+ORDER BY song_id, ord
+ON CONFLICT DO NOTHING
+""")
+
+artist_table_merge = ("""
+INSERT INTO artists (
+    artist_id, name, location, latitude, longitude
+)
+SELECT DISTINCT ON (artist_id) artist_id, name, location, latitude, longitude
+FROM artists_staging
+ORDER BY artist_id, ord
+ON CONFLICT DO NOTHING
+""")
+
+time_table_merge = ("""
+INSERT INTO time (
+    start_time, hour, day, week, month, year, weekday
+)
+SELECT DISTINCT ON (start_time) start_time, hour, day, week, month, year, weekday
+FROM time_staging
+ORDER BY start_time, ord
+ON CONFLICT DO NOTHING
+""")
+
 # FIND SONGS
 
 song_select = ("""
@@ -110,7 +268,31 @@ JOIN artists ON songs.artist_id = artists.artist_id
 WHERE songs.title = %s AND artists.name = %s AND songs.duration = %s
 """)
 
+song_lookup_select = ("""
+SELECT songs.title, artists.name, songs.duration, songs.song_id, artists.artist_id
+FROM songs
+JOIN artists ON songs.artist_id = artists.artist_id
+""")
+
+# FILE MANIFEST
+
+manifest_select = ("""
+SELECT path, size, mtime, hash FROM file_manifest
+""")
+
+manifest_upsert = ("""
+INSERT INTO file_manifest (
+    path, size, mtime, hash
+) VALUES (%s, %s, %s, %s)
+ON CONFLICT (path) DO UPDATE SET size = EXCLUDED.size, mtime = EXCLUDED.mtime, hash = EXCLUDED.hash, loaded_at = now()
+""")
+
+manifest_delete = ("""
+DELETE FROM file_manifest WHERE path = %s
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_event_index_create, manifest_table_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop]
+staging_table_queries = [songplay_staging_create, user_staging_create, song_staging_create, artist_staging_create, time_staging_create]
@@ -0,0 +1,319 @@
+import glob
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from decimal import Decimal
+from unittest import mock
+
+import pandas as pd
+import pytest
+
+from benchmark import time_records_per_row
+from etl import (drop_loaded_times, file_entry, get_files, load_song_lookup, lookup_song_ids, mark_loaded_times,
+                 process_data, process_data_parallel, process_log_file, process_song_file, prune_manifest,
+                 select_changed_files, time_records)
+import psycopg2
+from sql_queries import manifest_delete, manifest_upsert
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+class FakeCursor:
+    """
+    Cursor that answers every query with fixed rows and records what it was asked to run.
+    """
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.executed = []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+    def executemany(self, query, params):
+        self.executed.extend((query, row) for row in params)
+
+    def fetchall(self):
+        return self.rows
+
+
+def read_files(pattern):
+    return pd.concat([pd.read_json(f, lines=True) for f in sorted(glob.glob(os.path.join(DATA, pattern),
+                                                                              recursive=True))])
+
+
+@pytest.fixture(scope='module')
+def songs():
+    """The sample songs as song_lookup_select returns them, with durations as NUMERIC Decimals."""
+    df = read_files('song_data/**/*.json')
+    return [(row.title, row.artist_name, Decimal(str(row.duration)), row.song_id, row.artist_id)
+            for row in df.itertuples()]
+
+
+@pytest.fixture(scope='module')
+def events(songs):
+    """
+    The sample NextSong events, with some rewritten to play a sample song: exactly, with a duration
+    that differs past the recorded scale, and by another artist.
+    """
+    df = read_files('log_data/**/*.json')
+    df = df[df['page'] == 'NextSong'].reset_index(drop=True)
+    for i, (title, artist, duration, song_id, artist_id) in enumerate(songs[:20]):
+        df.loc[3 * i, ['song', 'artist', 'length']] = [title, artist, float(duration)]
+        df.loc[3 * i + 1, ['song', 'artist', 'length']] = [title, artist, float(duration) + 0.001]
+        df.loc[3 * i + 2, ['song', 'artist', 'length']] = [title, 'Someone Else', float(duration)]
+    return df
+
+
+def song_select(songs, title, artist, length):
+    """The original per-row lookup: song_select's first match, or no ids."""
+    for song, name, duration, song_id, artist_id in songs:
+        # psycopg2 sends the float as its repr, which Postgres compares as NUMERIC
+        if song == title and name == artist and duration == Decimal(repr(float(length))):
+            return song_id, artist_id
+    return None, None
+
+
+def test_lookup_matches_song_select(songs, events):
+    matches = lookup_song_ids(events, load_song_lookup(FakeCursor(songs)))
+
+    expected = [song_select(songs, row.song, row.artist, row.length) for row in events.itertuples()]
+    resolved = [(song_id if pd.notna(song_id) else None, artist_id if pd.notna(artist_id) else None)
+                for song_id, artist_id in matches.itertuples(index=False)]
+    assert resolved == expected
+    assert sum(song_id is not None for song_id, artist_id in expected) == 21
+
+
+def test_lookup_keeps_event_order_and_length(songs, events):
+    shuffled = events.sample(frac=1, random_state=0)
+    matches = lookup_song_ids(shuffled, load_song_lookup(FakeCursor(songs)))
+
+    assert len(matches) == len(shuffled)
+    expected = [song_select(songs, row.song, row.artist, row.length)[0] for row in shuffled.itertuples()]
+    assert [song_id if pd.notna(song_id) else None for song_id in matches['song_id']] == expected
+
+
+def test_song_without_duration_never_matches():
+    # song_select compares durations with =, which is never true for NULL
+    lookup = load_song_lookup(FakeCursor([('Song', 'Artist', None, 'S1', 'A1')]))
+    events = pd.DataFrame({'song': ['Song'], 'artist': ['Artist'], 'length': [float('nan')]})
+
+    assert lookup_song_ids(events, lookup)['song_id'].isna().all()
+
+
+@pytest.fixture(scope='module')
+def timestamps():
+    df = read_files('log_data/**/*.json')
+    return pd.to_datetime(df[df['page'] == 'NextSong']['ts'], unit='ms')
+
+
+def test_time_records_match_timestamp_attributes(timestamps):
+    expected = time_records_per_row(timestamps).drop_duplicates('start_time').reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(time_records(timestamps), expected, check_dtype=False)
+
+
+def test_week_is_the_iso_week_at_year_boundaries():
+    t = pd.Series(pd.to_datetime(['2018-12-31 10:00', '2019-01-01 10:00', '2021-01-03 10:00']))
+
+    pd.testing.assert_frame_equal(time_records(t), time_records_per_row(t), check_dtype=False)
+
+
+def test_loaded_times_are_dropped_once(timestamps):
+    loaded_times = set()
+    first, second = timestamps[:len(timestamps) * 3 // 4], timestamps[len(timestamps) // 4:]
+
+    rows = []
+    for half in (first, second):
+        time_df = drop_loaded_times(time_records(half), loaded_times)
+        mark_loaded_times(time_df, loaded_times)
+        rows.append(time_df)
+
+    # the per-row load inserted every timestamp of each file and let ON CONFLICT drop repeats
+    expected = time_records_per_row(timestamps).drop_duplicates('start_time')
+    loaded = pd.concat(rows)
+    assert loaded['start_time'].is_unique
+    assert set(loaded['start_time']) == set(expected['start_time'])
+    assert set(rows[1]['start_time']).isdisjoint(first)
+
+
+@pytest.fixture
+def files(tmp_path):
+    """Four loaded files, each with its manifest entry, plus one that was never loaded."""
+    paths = {}
+    for name in ('unchanged', 'touched', 'changed', 'new'):
+        paths[name] = str(tmp_path / f'{name}.json')
+        with open(paths[name], 'w') as f:
+            f.write(f'{{"name": "{name}"}}\n')
+    manifest = [(paths[name], *file_entry(paths[name])) for name in ('unchanged', 'touched', 'changed')]
+
+    os.utime(paths['touched'], (0, 12345))
+    with open(paths['changed'], 'w') as f:
+        f.write('{"name": "edited"}\n')
+    return paths, manifest
+
+
+def test_only_new_and_changed_files_are_selected(files):
+    paths, manifest = files
+    cur = FakeCursor(manifest)
+
+    changed_files, entries = select_changed_files(cur, list(paths.values()))
+
+    assert changed_files == [paths['changed'], paths['new']]
+    assert entries == {f: file_entry(f) for f in changed_files}
+    # the touched file is not loaded again, but its entry is refreshed
+    assert cur.executed[1:] == [(manifest_upsert, (paths['touched'], *file_entry(paths['touched'])))]
+
+
+def test_manifest_entries_of_removed_files_are_pruned(files, tmp_path):
+    paths, manifest = files
+    elsewhere = ('/other/data/song.json', 1, 0.0, '0' * 64)
+    cur = FakeCursor(manifest + [elsewhere])
+
+    # only entries under the directory being loaded are considered
+    assert prune_manifest(cur, str(tmp_path), [paths['unchanged'], paths['new']]) == 2
+    assert cur.executed[1:] == [(manifest_delete, (paths['touched'],)), (manifest_delete, (paths['changed'],))]
+
+
+@pytest.mark.parametrize('directory, func, tables', [
+    ('song_data', process_song_file, ['songs', 'artists']),
+    ('log_data', process_log_file, ['time', 'users', 'songplays']),
+])
+def test_process_data_applies_per_file_functions(directory, func, tables):
+    # the original call, process_data(cur, conn, filepath=..., func=process_song_file), loads one file at a time
+    conn = mock.Mock()
+    with mock.patch('etl.load_records') as load_records:
+        process_data(FakeCursor(), conn, filepath=os.path.join(DATA, directory), func=func)
+
+    num_files = len(get_files(os.path.join(DATA, directory)))
+    assert load_records.call_count == conn.commit.call_count - 1 == num_files
+    for call in load_records.call_args_list:
+        records = call.args[1]
+        assert len(records) == 1 and list(records[0]) == tables
+
+
+def test_full_run_records_the_manifest_without_reading_files_twice(log_dir):
+    cur = FakeCursor()
+    with mock.patch('etl.file_hash', side_effect=AssertionError('full runs do not hash')):
+        process_data(cur, mock.Mock(), filepath=str(log_dir), func=mock.Mock())
+
+    recorded = [params for query, params in cur.executed if query == manifest_upsert]
+    assert [path for path, size, mtime, digest in recorded] == get_files(str(log_dir))
+    assert all(digest is None for path, size, mtime, digest in recorded)
+
+
+def test_file_recorded_without_a_hash_is_loaded_once_touched(files):
+    paths, manifest = files
+    cur = FakeCursor([(path, size, mtime, None) for path, size, mtime, digest in manifest])
+
+    changed_files, entries = select_changed_files(cur, [paths['unchanged'], paths['touched']])
+
+    assert changed_files == [paths['touched']]
+
+
+def read_name(filepath):
+    return {'file': os.path.basename(filepath)}
+
+
+def run_parallel(directory, connection, executor=ThreadPoolExecutor, **options):
+    """
+    Run process_data_parallel over a directory with worker threads and mock connections. Records
+    of files named bad*.json fail to load. Returns the failed files and the files loaded, in order.
+    """
+    loaded = []
+
+    def load_records(cur, records, table_loads):
+        if any(record['file'].startswith('bad') for record in records):
+            raise psycopg2.DataError('invalid input syntax')
+        loaded.extend(record['file'] for record in records)
+
+    with mock.patch('etl.psycopg2.connect', side_effect=lambda dsn: connection()), \
+            mock.patch('etl.ProcessPoolExecutor', executor), \
+            mock.patch('etl.load_records', side_effect=load_records):
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(
+            failed=process_data_parallel('dsn', str(directory), read_name, 2, **options)), daemon=True)
+        thread.start()
+        thread.join(10)
+
+    assert not thread.is_alive(), 'process_data_parallel did not finish'
+    return [os.path.basename(f) for f in result['failed']], loaded
+
+
+def mock_connection():
+    conn = mock.Mock()
+    conn.cursor.return_value.fetchall.return_value = []
+    return conn
+
+
+@pytest.fixture
+def log_dir(tmp_path):
+    for name in ('a', 'b', 'bad', 'c', 'd', 'e', 'f'):
+        (tmp_path / f'{name}.json').write_text('{}\n')
+    return tmp_path
+
+
+def test_parallel_load_keeps_file_order_and_isolates_failures(log_dir):
+    failed, loaded = run_parallel(log_dir, mock_connection, loaders=1, batch_size=2)
+
+    assert failed == ['bad.json']
+    assert loaded == [os.path.basename(f) for f in get_files(str(log_dir)) if 'bad' not in f]
+
+
+def test_failed_rollback_does_not_stall_the_run(log_dir):
+    # a loader whose rollback raises keeps taking batches, so the producer never blocks on a full queue
+    def broken_connection():
+        conn = mock_connection()
+        conn.rollback.side_effect = psycopg2.InterfaceError('connection already closed')
+        return conn
+
+    failed, loaded = run_parallel(log_dir, broken_connection, loaders=1, batch_size=1)
+
+    assert 'bad.json' in failed
+    assert sorted(failed + loaded) == sorted(os.path.basename(f) for f in get_files(str(log_dir)))
+
+
+class BreakingExecutor(ThreadPoolExecutor):
+    """Thread pool that breaks, as a process pool does when a worker dies, after a few files."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.submitted = 0
+
+    def submit(self, fn, *args):
+        self.submitted += 1
+        if self.submitted > 3:
+            raise BrokenProcessPool('A process in the process pool was terminated abruptly')
+        return super().submit(fn, *args)
+
+
+def test_broken_pool_fails_the_remaining_files(log_dir):
+    connections = []
+
+    def connection():
+        connections.append(mock_connection())
+        return connections[-1]
+
+    failed, loaded = run_parallel(log_dir, connection, executor=BreakingExecutor, loaders=2, batch_size=1)
+
+    files = [os.path.basename(f) for f in get_files(str(log_dir))]
+    assert sorted(failed + loaded) == sorted(files)
+    assert set(files[3:]) <= set(failed)
+    assert all(conn.close.called for conn in connections)
+
+
+def test_connections_are_closed_when_the_run_fails(log_dir):
+    connections = []
+
+    def connection(dsn):
+        connections.append(mock_connection())
+        return connections[-1]
+
+    with mock.patch('etl.psycopg2.connect', side_effect=connection), \
+            mock.patch('etl.file_entry', side_effect=PermissionError('permission denied')):
+        with pytest.raises(PermissionError):
+            process_data_parallel('dsn', str(log_dir), read_name, 2, loaders=3)
+
+    assert len(connections) == 3
+    assert all(conn.close.called for conn in connections)